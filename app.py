@@ -1,40 +1,203 @@
 import os
+import re
 import sys
 import json
+import copy
+import atexit
+import sqlite3
 import uuid
+import hashlib
+import hmac
+import urllib.parse
+import urllib.request
+import urllib.error
 import time
 import logging
+import logging.handlers
 import asyncio
+import concurrent.futures
 import threading
+import heapq
+import bisect
 import queue
+import unicodedata
+import zlib
+from types import MappingProxyType
 import psutil
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 from flask import Flask, session, request, render_template, jsonify, redirect
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from telethon import TelegramClient, events
 from telethon.errors import SessionPasswordNeededError, PhoneCodeExpiredError, PhoneCodeInvalidError, PasswordHashInvalidError
+from telethon.errors import AuthKeyUnregisteredError, UserDeactivatedError, PeerIdInvalidError, ChannelInvalidError, ChatIdInvalidError
+from telethon.errors import FloodWaitError, SlowModeWaitError
 from telethon.sessions import StringSession
+from telethon.tl.types import InputPeerUser, InputPeerChat, InputPeerChannel, InputPeerSelf
 
 # تكوين السجلات المحسن
-logging.basicConfig(
-    level=logging.INFO, 
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('telegram_monitoring.log', encoding='utf-8')
-    ]
-)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", "telegram_monitoring.log")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text | json
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN", "")  # فارغ = حسب الحجم، أو midnight / H / D
+# حد السجلات لكل تصنيف (extra={'category': ...}) في الثانية، وما زاد يُسجل منه واحد كل LOG_SAMPLE_EVERY
+LOG_CATEGORY_RATE = float(os.environ.get("LOG_CATEGORY_RATE", 5))
+LOG_CATEGORY_BURST = int(os.environ.get("LOG_CATEGORY_BURST", 20))
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", 100))
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonLogFormatter(logging.Formatter):
+    """سطر JSON واحد لكل سجل"""
+    
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        category = getattr(record, 'category', None)
+        if category:
+            entry["category"] = category
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class TextLogFormatter(logging.Formatter):
+    """التنسيق النصي المعتاد مع عدد السجلات المحذوفة قبل السجل إن وُجدت"""
+    
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{text} [+{suppressed} suppressed]" if suppressed else text
+
+class LogRateLimitFilter(logging.Filter):
+    """تحديد معدل السجلات المتكررة لكل تصنيف (token bucket) مع أخذ عينة مما يتجاوز الحد
+    
+    السجلات بدون تصنيف والأخطاء تمر دائماً.
+    """
+    
+    def __init__(self, rate=LOG_CATEGORY_RATE, burst=LOG_CATEGORY_BURST, sample_every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = sample_every
+        self.buckets = {}
+        self.lock = Lock()
+    
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        if category is None or record.levelno >= logging.ERROR or self.rate <= 0:
+            return True
+        
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(category)
+            if bucket is None:
+                bucket = self.buckets[category] = [float(self.burst), now, 0]
+            tokens, updated, suppressed = bucket
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            
+            if tokens >= 1 or (self.sample_every and (suppressed + 1) % self.sample_every == 0):
+                bucket[:] = [max(0.0, tokens - 1), now, 0]
+                # عدد السجلات المحذوفة قبل هذا السجل
+                record.suppressed = suppressed
+                return True
+            
+            bucket[:] = [tokens, now, suppressed + 1]
+            return False
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """يضع السجل في القائمة دون تنسيقه - التنسيق والكتابة في thread المستمع"""
+    
+    def prepare(self, record):
+        return record
+
+def configure_logging():
+    """مستمع في thread منفصل يكتب للشاشة وملف دوّار، والـ hot path يضيف للقائمة فقط"""
+    formatter = JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter(LOG_TEXT_FORMAT)
+    
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    handlers = [logging.StreamHandler(), file_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(LogRateLimitFilter())
+    
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [queue_handler]
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
 logger = logging.getLogger(__name__)
 
 # إنشاء التطبيق
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", os.urandom(24))
 
-# إعداد SocketIO
+# إعداد SocketIO - وضع التشغيل يطابق عامل gunicorn
+SOCKETIO_ASYNC_MODES = ('threading', 'eventlet', 'gevent', 'gevent_uwsgi')
+
+def detect_async_mode():
+    """eventlet/gevent فقط إن كانت العملية مرقّعة مسبقاً (عامل gunicorn أو main.py)
+    
+    الكود يحجز threads حقيقية (run_coroutine، المجدول، قائمة التنبيهات) ويبث منها،
+    واختيار eventlet دون monkey_patch يجمّد الخادم - لذا threading هو الافتراضي.
+    """
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('socket'):
+        return 'eventlet'
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        return 'gevent'
+    return 'threading'
+
+SOCKETIO_ASYNC_MODE = os.environ.get("SOCKETIO_ASYNC_MODE") or detect_async_mode()
+if SOCKETIO_ASYNC_MODE not in SOCKETIO_ASYNC_MODES:
+    logger.warning(f"Unsupported SOCKETIO_ASYNC_MODE '{SOCKETIO_ASYNC_MODE}', using threading")
+    SOCKETIO_ASYNC_MODE = 'threading'
+
+# النشر الموزع: كل عملية (shard) تستضيف جزءاً من الحسابات حسب hash معرف المستخدم
+SHARD_COUNT = max(1, int(os.environ.get("SHARD_COUNT", 1)))
+SHARD_ID = int(os.environ.get("SHARD_ID", 0))
+SHARD_URLS = [url.strip().rstrip('/') for url in os.environ.get("SHARD_URLS", "").split(',') if url.strip()]
+SHARD_VNODES = int(os.environ.get("SHARD_VNODES", 160))
+SHARD_PROXY_TIMEOUT = float(os.environ.get("SHARD_PROXY_TIMEOUT", 30))
+
+# وسيط الرسائل لبث أحداث Socket.IO بين الأجزاء (redis://... أو zmq+tcp://... عبر shard_broker.py)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None
+
+if SHARD_COUNT > 1:
+    if not SOCKETIO_MESSAGE_QUEUE:
+        logger.warning("SHARD_COUNT > 1 without SOCKETIO_MESSAGE_QUEUE - dashboards only receive events from their own shard")
+    if not os.environ.get("SESSION_SECRET"):
+        logger.warning("SHARD_COUNT > 1 without SESSION_SECRET - sessions will not be valid across shards")
+
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*",
-    async_mode='threading',
+    async_mode=SOCKETIO_ASYNC_MODE,
+    message_queue=SOCKETIO_MESSAGE_QUEUE,
     ping_timeout=20, 
     ping_interval=10,
     logger=False, 
@@ -46,9 +209,88 @@ SESSIONS_DIR = "sessions"
 if not os.path.exists(SESSIONS_DIR):
     os.makedirs(SESSIONS_DIR)
 
+# سجل المستخدمين: user_id -> UserState
+# USERS_LOCK يغطي الإضافة والحذف فقط، وكل مستخدم له قفله الخاص
 USERS = {}
 USERS_LOCK = Lock()
+
+# مخزن الإعدادات: json (ملف لكل مستخدم) أو sqlite (ملف واحد لكل المستخدمين)
+SETTINGS_BACKEND = os.environ.get("SETTINGS_BACKEND", "json")
+SETTINGS_DB_PATH = os.environ.get("SETTINGS_DB_PATH", os.path.join(SESSIONS_DIR, "settings.db"))
+SETTINGS_FLUSH_DELAY = float(os.environ.get("SETTINGS_FLUSH_DELAY", 1.0))
+
+# إعادة الاتصال التلقائي للحسابات المصرح بها عند بدء التشغيل
+AUTO_RECONNECT = os.environ.get("AUTO_RECONNECT", "1") == "1"
+RECONNECT_CONCURRENCY = int(os.environ.get("RECONNECT_CONCURRENCY", 8))
+RECONNECT_MAX_ATTEMPTS = int(os.environ.get("RECONNECT_MAX_ATTEMPTS", 3))
+RECONNECT_BACKOFF = float(os.environ.get("RECONNECT_BACKOFF", 2.0))
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "admin123")
+# رمز وصول /metrics لأدوات الجمع (فارغ = جلسة الأدمن فقط)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# ذاكرة الكيانات المؤقتة (المحادثات والمرسلين)
+ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", 4096))
+ENTITY_CACHE_TTL = int(os.environ.get("ENTITY_CACHE_TTL", 900))
+
+# إعدادات قائمة التنبيهات
+ALERT_QUEUE_MAXSIZE = int(os.environ.get("ALERT_QUEUE_MAXSIZE", 10000))
+ALERT_FLUSH_INTERVAL = float(os.environ.get("ALERT_FLUSH_INTERVAL", 1.0))
+ALERT_USER_BURST_LIMIT = int(os.environ.get("ALERT_USER_BURST_LIMIT", 50))
+ALERT_OVERFLOW_POLICY = os.environ.get("ALERT_OVERFLOW_POLICY", "drop_oldest")  # drop_oldest | drop_new
+SAVED_MESSAGES_MAX_PENDING = int(os.environ.get("SAVED_MESSAGES_MAX_PENDING", 200))
+SAVED_MESSAGES_SEND_TIMEOUT = float(os.environ.get("SAVED_MESSAGES_SEND_TIMEOUT", 30))
+
+# دمج التنبيهات المكررة (نفس المحتوى ونفس الكلمة خلال النافذة) - 0 = معطل
+ALERT_DEDUP_WINDOW = int(os.environ.get("ALERT_DEDUP_WINDOW", 300))
+ALERT_DEDUP_MAX_ENTRIES = int(os.environ.get("ALERT_DEDUP_MAX_ENTRIES", 2048))
+
+# سجل التنبيهات الدائم (فارغ = معطل) وسياسة الاحتفاظ
+ALERT_STORE_PATH = os.environ.get("ALERT_STORE_PATH", os.path.join(SESSIONS_DIR, "alerts.db"))
+ALERT_RETENTION_DAYS = float(os.environ.get("ALERT_RETENTION_DAYS", 30))
+ALERT_RETENTION_MAX_PER_USER = int(os.environ.get("ALERT_RETENTION_MAX_PER_USER", 100000))
+ALERT_COMPACT_INTERVAL = int(os.environ.get("ALERT_COMPACT_INTERVAL", 3600))
+
+# ملخصات الرسائل المحفوظة (0 = إرسال فوري لكل تنبيه)
+ALERT_DIGEST_INTERVAL = int(os.environ.get("ALERT_DIGEST_INTERVAL", 0))
+ALERT_DIGEST_MAX_ALERTS = int(os.environ.get("ALERT_DIGEST_MAX_ALERTS", 20))
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+# عدد event loops المشتركة بين كل عملاء التليجرام
+CLIENT_LOOP_THREADS = int(os.environ.get("CLIENT_LOOP_THREADS", 4))
+
+# تجميع أحداث السجل والتنبيهات لكل غرفة قبل إرسالها
+SOCKETIO_FLUSH_INTERVAL = float(os.environ.get("SOCKETIO_FLUSH_INTERVAL", 0.25))
+SOCKETIO_MAX_BUFFERED = int(os.environ.get("SOCKETIO_MAX_BUFFERED", 500))
+# آخر N حدث لكل غرفة تُعاد للوحة بعد انقطاع قصير
+SOCKETIO_REPLAY_BUFFER = int(os.environ.get("SOCKETIO_REPLAY_BUFFER", 200))
+
+# بث تغييرات المستخدمين للوحة الأدمن (namespace /admin)
+ADMIN_FEED_INTERVAL = float(os.environ.get("ADMIN_FEED_INTERVAL", 1.0))
+
+# مُجدول المراقبة (إشارات الحياة والإرسال المجدول)
+HEARTBEAT_INTERVAL = int(os.environ.get("HEARTBEAT_INTERVAL", 10))
+
+# وتيرة الإرسال لكل حساب (افتراضياً رسالة كل 3 ثوانٍ كما كان سابقاً)
+SEND_RATE_PER_SECOND = float(os.environ.get("SEND_RATE_PER_SECOND", 1 / 3))
+SEND_BURST = int(os.environ.get("SEND_BURST", 1))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", 3))
+PROGRESS_BATCH_SIZE = int(os.environ.get("PROGRESS_BATCH_SIZE", 10))
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", 2.0))
+
+# تسجيل تدفق الرسائل لإعادة تشغيله لاحقاً (فارغ = معطل)
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "")
+CAPTURE_REDACT = os.environ.get("CAPTURE_REDACT", "none")  # none | digits | text
+CAPTURE_FLUSH_INTERVAL = float(os.environ.get("CAPTURE_FLUSH_INTERVAL", 1.0))
+
+# استدراك الرسائل الفائتة بعد انقطاع الاتصال انطلاقاً من آخر رسالة معالجة في كل محادثة
+CATCHUP_ENABLED = os.environ.get("CATCHUP_ENABLED", "1") == "1"
+CATCHUP_MAX_MESSAGES = int(os.environ.get("CATCHUP_MAX_MESSAGES", 2000))
+CATCHUP_MAX_PER_CHAT = int(os.environ.get("CATCHUP_MAX_PER_CHAT", 300))
+CATCHUP_MAX_CHATS = int(os.environ.get("CATCHUP_MAX_CHATS", 200))
+CATCHUP_CONCURRENCY = int(os.environ.get("CATCHUP_CONCURRENCY", 3))
+CATCHUP_MAX_AGE = int(os.environ.get("CATCHUP_MAX_AGE", 6 * 3600))
+CHECKPOINT_FLUSH_INTERVAL = float(os.environ.get("CHECKPOINT_FLUSH_INTERVAL", 10))
+CHECKPOINT_MAX_CHATS = int(os.environ.get("CHECKPOINT_MAX_CHATS", 2000))
 
 # بيانات Telegram API
 API_ID = os.environ.get('TELEGRAM_API_ID')
@@ -57,16 +299,461 @@ API_HASH = os.environ.get('TELEGRAM_API_HASH')
 if not API_ID or not API_HASH:
     logger.error("❌ يجب إضافة TELEGRAM_API_ID و TELEGRAM_API_HASH في متغيرات البيئة")
 
+# =========================== 
+# مقاييس الأداء بصيغة Prometheus
+# ===========================
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Counter:
+    """عداد تراكمي بتسميات اختيارية"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+    
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    """قيمة لحظية - تُحسب عند القراءة من دالة تُرجع رقماً أو dict تسمية -> رقم"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name, documentation, labelnames=(), callback=None, kind='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.kind = kind
+    
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+    
+    def samples(self):
+        if self.callback is None:
+            yield from super().samples()
+            return
+        
+        value = self.callback()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, sample in value.items():
+            yield self.name, _format_labels(self.labelnames, labels), sample
+
+class Histogram(Counter):
+    """توزيع قيم (بالثواني) على حدود ثابتة"""
+    
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.values.items()]
+        
+        labelnames = self.labelnames + ('le',)
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", _format_labels(labelnames, labels + (bound,)), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), count
+
+class MetricsRegistry:
+    """سجل المقاييس ومُخرج نص /metrics"""
+    
+    def __init__(self):
+        self.metrics = []
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name, documentation, labelnames=(), callback=None, kind='gauge'):
+        return self.register(Gauge(name, documentation, labelnames, callback, kind))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{labels} {value}")
+            except Exception as e:
+                logger.error(f"Error collecting metric {metric.name}: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+# إنشاء سجل المقاييس العالمي - المقاييس المعتمدة على كائنات لاحقة تُسجل بعد إنشائها
+metrics = MetricsRegistry()
+MESSAGE_STAGE_SECONDS = metrics.histogram(
+    'telegram_message_stage_seconds', 'Time spent in each _handle_new_message stage', ('stage',)
+)
+MESSAGES_TOTAL = metrics.counter('telegram_messages_total', 'Text messages received per user', ('user',))
+ALERTS_TOTAL = metrics.counter('telegram_alerts_total', 'Keyword alerts triggered per user', ('user',))
+ALERTS_DEDUPLICATED = metrics.counter(
+    'telegram_alerts_deduplicated_total', 'Alerts folded into an earlier copy of the same message', ('user',)
+)
+ALERT_QUEUE_WAIT_SECONDS = metrics.histogram(
+    'alert_queue_wait_seconds', 'Time alerts spend in AlertQueue before being flushed'
+)
+RUN_COROUTINE_SECONDS = metrics.histogram(
+    'run_coroutine_wait_seconds', 'Time callers block in TelegramClientManager.run_coroutine'
+)
+RUN_COROUTINE_TIMEOUTS = metrics.counter(
+    'run_coroutine_timeouts_total', 'run_coroutine calls that exceeded their timeout'
+)
+CATCHUP_MESSAGES_TOTAL = metrics.counter(
+    'telegram_catchup_messages_total', 'Missed messages fetched after a reconnect per user', ('user',)
+)
+CATCHUP_SECONDS = metrics.histogram(
+    'telegram_catchup_seconds', 'Duration of a post-reconnect catch-up run'
+)
+
+def metric_user_label(user_id):
+    """تسمية قصيرة للمستخدم في المقاييس (نفس البادئة المعروضة في لوحة الأدمن)"""
+    return user_id[:8]
+
+# =========================== 
+# توزيع الحسابات على الأجزاء (Consistent Hashing)
+# ===========================
+class ShardRing:
+    """حلقة hash ثابتة: كل حساب يُسند لجزء واحد، وإضافة جزء تنقل ~1/N من الحسابات فقط"""
+    
+    def __init__(self, shard_count=SHARD_COUNT, shard_id=SHARD_ID, urls=SHARD_URLS, vnodes=SHARD_VNODES):
+        self.shard_count = shard_count
+        self.shard_id = shard_id
+        self.urls = urls
+        points = sorted(
+            (self._hash(f"shard-{shard}#{vnode}"), shard)
+            for shard in range(shard_count)
+            for vnode in range(vnodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+    
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+    
+    @property
+    def distributed(self):
+        return self.shard_count > 1
+    
+    def shard_for(self, user_id):
+        """الجزء المالك للحساب"""
+        if not self.distributed:
+            return self.shard_id
+        index = bisect.bisect(self.hashes, self._hash(str(user_id))) % len(self.hashes)
+        return self.shards[index]
+    
+    def owns(self, user_id):
+        return self.shard_for(user_id) == self.shard_id
+    
+    def url_for(self, shard):
+        return self.urls[shard] if shard < len(self.urls) else None
+    
+    def new_user_id(self):
+        """معرف مستخدم جديد يملكه هذا الجزء - حتى لا يُنشأ الحساب على جزء ثم يُخدم من آخر"""
+        while True:
+            user_id = str(uuid.uuid4())
+            if self.owns(user_id):
+                return user_id
+
+# إنشاء الحلقة العالمية
+shard_ring = ShardRing()
+
+# =========================== 
+# طبقة إرسال Socket.IO المجمّعة
+# ===========================
+class SocketEmitter:
+    """تجميع log_update و keyword_alert لكل غرفة وتفريغها معاً كل بضع مئات من الميلي ثانية
+    
+    كل حدث يُرسل باسمه الأصلي وبترتيب وصوله؛ الأحداث الفورية (connection_status...)
+    تنتظر خلف المخزن إن كان فيه ما لم يُرسل بعد حتى لا تسبق سطور السجل التي قبلها.
+    يتتبع عدد اللوحات المتصلة بكل غرفة ويتجاهل الأحداث الموجهة لغرف فارغة.
+    الأحداث المجمّعة تحمل رقم تسلسل (seq) لكل غرفة وتُحفظ في حلقة محدودة حتى مع
+    غياب اللوحة، لتُعاد للوحة التي تعود بآخر رقم رأته.
+    """
+    
+    BATCHED_EVENTS = ('log_update', 'keyword_alert', 'alert_seen_in')
+    
+    def __init__(self, flush_interval=SOCKETIO_FLUSH_INTERVAL, max_buffered=SOCKETIO_MAX_BUFFERED,
+                 replay_size=SOCKETIO_REPLAY_BUFFER):
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.replay_size = replay_size
+        self.buffers = {}
+        self.room_members = {}
+        self.history = {}
+        self.sequences = {}
+        # يتغير مع كل تشغيل - أرقام التسلسل القديمة لا معنى لها بعد إعادة التشغيل
+        self.epoch = uuid.uuid4().hex[:8]
+        self.suppressed = 0
+        self.lock = Lock()
+        # يحفظ ترتيب البث بين التفريغ والأحداث الفورية - يُؤخذ دائماً قبل self.lock
+        self.emit_lock = Lock()
+        self.started = False
+    
+    def start(self):
+        """تشغيل مهمة التفريغ داخل بيئة الخادم (thread أو greenlet حسب async_mode)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        socketio.start_background_task(self._flush_loop)
+    
+    def room_joined(self, room):
+        """تسجيل انضمام لوحة تحكم للغرفة"""
+        with self.lock:
+            self.room_members[room] = self.room_members.get(room, 0) + 1
+    
+    def room_left(self, room):
+        """تسجيل مغادرة لوحة تحكم للغرفة"""
+        with self.lock:
+            count = self.room_members.get(room, 0) - 1
+            if count > 0:
+                self.room_members[room] = count
+            else:
+                self.room_members.pop(room, None)
+                self.buffers.pop(room, None)
+    
+    def has_listeners(self, room):
+        """هل توجد لوحة تحكم متصلة بالغرفة
+        
+        في النشر الموزع قد تكون اللوحة متصلة بجزء آخر، فلا يمكن الحكم محلياً.
+        """
+        return shard_ring.distributed or room in self.room_members
+    
+    def emit(self, event, data, to):
+        """إضافة حدث لمخزن الغرفة - آمن من أي thread"""
+        if event not in self.BATCHED_EVENTS:
+            if not self.has_listeners(to):
+                self.suppressed += 1
+                return
+            with self.emit_lock:
+                with self.lock:
+                    buffer = self.buffers.get(to)
+                    if buffer:
+                        buffer.append({"event": event, "data": data, "seq": None})
+                        return
+                socketio.emit(event, data, to=to)
+            return
+        
+        with self.lock:
+            seq = self.sequences.get(to, 0) + 1
+            self.sequences[to] = seq
+            entry = {"event": event, "data": data, "seq": seq}
+            
+            # الحلقة تحفظ المرجع فقط - لا تسلسل ولا بث حتى تعود لوحة
+            if self.replay_size > 0:
+                history = self.history.get(to)
+                if history is None:
+                    history = self.history[to] = deque(maxlen=self.replay_size)
+                history.append(entry)
+            
+            if not self.has_listeners(to):
+                # لا توجد لوحة متصلة - لا داعي للتسلسل والبث
+                self.suppressed += 1
+                return
+            
+            buffer = self.buffers.get(to)
+            if buffer is None:
+                buffer = self.buffers[to] = deque(maxlen=self.max_buffered)
+            buffer.append(entry)
+    
+    def replay(self, room, last_seq=None, epoch=None):
+        """الأحداث التي فاتت لوحة عادت بآخر رقم رأته
+        
+        complete=False يعني أن بعض ما فات خرج من الحلقة (أو أُعيد تشغيل الخادم)
+        فتحتاج اللوحة لتحميل كامل بدل الاعتماد على الإعادة.
+        """
+        with self.lock:
+            history = list(self.history.get(room, ()))
+            current = self.sequences.get(room, 0)
+        
+        last_seq = self._parse_seq(last_seq)
+        if epoch != self.epoch or last_seq is None:
+            # قيمة مفقودة أو غير صالحة من العميل تعامل كلوحة جديدة تحتاج تحميلاً كاملاً
+            last_seq = 0
+            complete = False
+        else:
+            oldest = history[0]["seq"] if history else current + 1
+            complete = last_seq >= oldest - 1 and last_seq <= current
+        
+        return {
+            "epoch": self.epoch,
+            "seq": current,
+            "complete": complete,
+            "events": [entry for entry in history if entry["seq"] > last_seq]
+        }
+    
+    @staticmethod
+    def _parse_seq(value):
+        """رقم تسلسل صالح (عدد صحيح غير سالب) من auth العميل أو None"""
+        if isinstance(value, bool):
+            return None
+        try:
+            seq = int(value)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        return seq if seq >= 0 else None
+    
+    def _flush_loop(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Socket emitter flush error: {str(e)}")
+    
+    def flush(self):
+        """إرسال ما تجمع لكل غرفة بأسماء الأحداث الأصلية وبترتيبها"""
+        with self.emit_lock:
+            with self.lock:
+                if not self.buffers:
+                    return
+                buffers, self.buffers = self.buffers, {}
+            
+            for room, entries in buffers.items():
+                for entry in entries:
+                    data = entry["data"]
+                    if entry["seq"] is not None and isinstance(data, dict):
+                        data = dict(data, seq=entry["seq"], epoch=self.epoch)
+                    socketio.emit(entry["event"], data, to=room)
+
+# إنشاء طبقة الإرسال العالمية
+socket_emitter = SocketEmitter()
+
 # =========================== 
 # نظام Queue للتنبيهات المحسن
 # ===========================
+class SavedMessagesWorker:
+    """عامل تسليم مستقل لكل مستخدم - إرسال غير حاجز للرسائل المحفوظة على حلقة العميل"""
+    
+    def __init__(self, user_id, max_pending=SAVED_MESSAGES_MAX_PENDING, send_timeout=SAVED_MESSAGES_SEND_TIMEOUT):
+        self.user_id = user_id
+        self.send_timeout = send_timeout
+        self.pending = deque(maxlen=max_pending)
+        self.in_flight = False
+        self.lock = Lock()
+        self.sent = 0
+        self.failed = 0
+    
+    def submit(self, text):
+        """إضافة رسالة لقائمة التسليم وبدء الإرسال إن لم يكن هناك إرسال جارٍ"""
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                logger.warning(f"Saved messages backlog full for user {self.user_id}, dropping oldest", extra={'category': 'saved_messages'})
+            self.pending.append(text)
+        self._dispatch_next()
+    
+    def _dispatch_next(self):
+        """جدولة الرسالة التالية على حلقة العميل دون انتظار نتيجتها"""
+        with self.lock:
+            if self.in_flight or not self.pending:
+                return
+            text = self.pending.popleft()
+            self.in_flight = True
+        
+        user = USERS.get(self.user_id)
+        client_manager = user.client_manager if user else None
+        
+        if not client_manager or not client_manager.client or not client_manager.loop:
+            with self.lock:
+                self.in_flight = False
+                self.failed += 1 + len(self.pending)
+                self.pending.clear()
+            logger.warning(f"Saved messages skipped for user {self.user_id}: client not connected", extra={'category': 'saved_messages'})
+            return
+        
+        coro = asyncio.wait_for(
+            client_manager.client.send_message('me', text),
+            timeout=self.send_timeout
+        )
+        try:
+            future = client_manager.submit_coroutine(coro)
+        except Exception as e:
+            coro.close()
+            self._on_done(None, e)
+            return
+        
+        future.add_done_callback(self._on_done)
+    
+    def _on_done(self, future, error=None):
+        """استدعاء الإكمال - تسجيل النتيجة ثم إرسال التالي"""
+        if future is not None and not future.cancelled():
+            error = future.exception()
+        
+        with self.lock:
+            self.in_flight = False
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        
+        if error is None:
+            logger.info(f"Alert sent to saved messages for user {self.user_id}", extra={'category': 'saved_messages'})
+        else:
+            logger.error(f"Failed to send to saved messages for user {self.user_id}: {str(error) or type(error).__name__}")
+        
+        self._dispatch_next()
+
 class AlertQueue:
-    """نظام queue متقدم لإدارة التنبيهات"""
+    """نظام queue متقدم لإدارة التنبيهات - سعة محدودة، دمج التكرارات، وتفريغ على دفعات"""
     
-    def __init__(self):
-        self.queue = queue.Queue()
+    def __init__(self, maxsize=ALERT_QUEUE_MAXSIZE, flush_interval=ALERT_FLUSH_INTERVAL,
+                 user_burst_limit=ALERT_USER_BURST_LIMIT, overflow_policy=ALERT_OVERFLOW_POLICY):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.flush_interval = flush_interval
+        self.user_burst_limit = user_burst_limit
+        self.overflow_policy = overflow_policy
         self.running = False
         self.thread = None
+        self.dropped = 0
+        self.coalesced = 0
+        self.delivery_workers = {}
+        self.delivery_lock = Lock()
+        self.digest_config = {}
+        self.digests = {}
     
     def start(self):
         """بدء معالج التنبيهات"""
@@ -81,29 +768,157 @@ class AlertQueue:
         self.running = False
         if self.thread:
             self.thread.join(timeout=5)
+        self._flush_digests(force=True)
+    
+    def configure_user(self, user_id, digest_interval=ALERT_DIGEST_INTERVAL, digest_max_alerts=ALERT_DIGEST_MAX_ALERTS):
+        """ضبط وضع الملخص للمستخدم: إرسال كل N ثانية أو كل M تنبيه أيهما أسبق"""
+        with self.delivery_lock:
+            self.digest_config[user_id] = (max(0, int(digest_interval)), max(1, int(digest_max_alerts)))
+        if not digest_interval:
+            self._flush_digest(user_id)
     
     def add_alert(self, user_id, alert_data):
-        """إضافة تنبيه جديد للقائمة"""
+        """إضافة تنبيه جديد للقائمة - بدون انتظار حتى لا تتعطل حلقة العميل"""
+        self._enqueue({
+            'user_id': user_id,
+            'alert_data': alert_data,
+            'timestamp': time.time()
+        })
+    
+    def add_seen_in(self, user_id, original, group):
+        """نسخة من تنبيه سابق ظهرت في محادثة جديدة - تحديث السجل وإشعار متابعة بعد إرسال الأصل"""
+        self._enqueue({
+            'user_id': user_id,
+            'alert_data': original,
+            'timestamp': time.time(),
+            'seen_in_group': group
+        })
+    
+    @staticmethod
+    def _is_urgent(alert):
+        return 'seen_in_group' not in alert and bool(alert['alert_data'].get('urgent'))
+    
+    def _enqueue(self, alert):
+        user_id = alert['user_id']
         try:
-            self.queue.put({
-                'user_id': user_id,
-                'alert_data': alert_data,
-                'timestamp': time.time()
-            }, timeout=1)
+            self.queue.put_nowait(alert)
         except queue.Full:
-            logger.warning(f"Alert queue full for user {user_id}")
+            urgent = self._is_urgent(alert)
+            if self.overflow_policy == 'drop_oldest' or urgent:
+                # إخراج أقدم تنبيه غير عاجل لإفساح المجال - العاجل لا يُخرج إلا لعاجل أحدث
+                self._replace_oldest(alert, urgent)
+            self.dropped += 1
+            logger.warning(f"Alert queue full for user {user_id} ({self.overflow_policy})", extra={'category': 'alert_queue'})
+    
+    def _replace_oldest(self, alert, urgent):
+        """استبدال أقدم تنبيه غير عاجل (أو أقدم تنبيه إن كان الجديد عاجلاً والقائمة كلها عاجلة)"""
+        with self.queue.mutex:
+            pending = self.queue.queue
+            victim = next((index for index, item in enumerate(pending) if not self._is_urgent(item)), None)
+            if victim is None:
+                if not urgent or not pending:
+                    return
+                victim = 0
+            # عدد المهام غير المنتهية لا يتغير: عنصر خرج وآخر دخل مكانه
+            del pending[victim]
+            pending.append(alert)
+            self.queue.not_empty.notify()
     
     def _process_alerts(self):
-        """معالجة التنبيهات بشكل مستمر"""
+        """معالجة التنبيهات على دفعات - تفريغ واحد لكل نافذة زمنية"""
         while self.running:
+            self._flush_digests()
             try:
-                alert = self.queue.get(timeout=1)
-                self._send_alert(alert)
-                self.queue.task_done()
+                batch = [self.queue.get(timeout=1)]
             except queue.Empty:
                 continue
+            
+            # تجميع كل ما يصل خلال نافذة التفريغ - التنبيه العاجل ينهي النافذة فوراً
+            deadline = time.monotonic() + self.flush_interval
+            while not self._is_urgent(batch[-1]):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                self._flush(batch)
             except Exception as e:
                 logger.error(f"Error processing alert: {str(e)}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+    
+    def _flush(self, batch):
+        """تجميع الدفعة حسب المستخدم ودمج التنبيهات المتكررة"""
+        per_user = {}
+        seen_updates = {}
+        now = time.time()
+        for alert in batch:
+            ALERT_QUEUE_WAIT_SECONDS.observe(now - alert['timestamp'])
+            group = alert.get('seen_in_group')
+            if group is not None:
+                # تحديثات نفس التنبيه الأصلي في الدفعة تُجمع في إشعار واحد
+                update = seen_updates.setdefault(id(alert['alert_data']), (alert['user_id'], alert['alert_data'], []))
+                update[2].append(group)
+                continue
+            alert['alert_data']['reported_seen_in'] = alert['alert_data'].get('seen_in', 1)
+            per_user.setdefault(alert['user_id'], []).append(alert['alert_data'])
+        
+        # السجل الدائم يحفظ كل تنبيه كما وصل - قبل الدمج وحد الدفعة، معاملة واحدة للدفعة كلها
+        if alert_store.enabled:
+            try:
+                alert_store.append_many(
+                    (user_id, alert_data)
+                    for user_id, alerts in per_user.items()
+                    for alert_data in alerts
+                )
+            except Exception as e:
+                logger.error(f"Error writing alert history: {str(e)}")
+        
+        merged_per_user = {user_id: self._coalesce(alerts) for user_id, alerts in per_user.items()}
+        
+        for user_id, merged in merged_per_user.items():
+            # العاجلة أولاً حتى لا يقطعها حد الدفعة (الترتيب داخل كل فئة كما وصل)
+            merged.sort(key=lambda alert_data: not alert_data.get('urgent'))
+            if len(merged) > self.user_burst_limit:
+                overflow = len(merged) - self.user_burst_limit
+                self.dropped += overflow
+                logger.warning(
+                    f"Dropped {overflow} alerts for user {user_id} (burst limit {self.user_burst_limit})",
+                    extra={'category': 'alert_queue'}
+                )
+                merged = merged[:self.user_burst_limit]
+            self._send_alerts(user_id, merged)
+        
+        for user_id, original, groups in seen_updates.values():
+            self._send_seen_in(user_id, original, groups)
+    
+    def _coalesce(self, alerts):
+        """دمج تنبيهات نفس الكلمة ونفس المحادثة في تنبيه ملخص واحد"""
+        merged = {}
+        for alert_data in alerts:
+            key = (alert_data.get('keyword'), alert_data.get('group'))
+            digest = merged.get(key)
+            if digest is None:
+                merged[key] = dict(alert_data, count=1)
+                continue
+            
+            digest['count'] += 1
+            digest['message'] = alert_data.get('message', '')
+            digest['full_message'] = alert_data.get('full_message', '')
+            digest['message_time'] = alert_data.get('message_time', '')
+            digest['message_id'] = alert_data.get('message_id', '')
+            self.coalesced += 1
+        return list(merged.values())
+    
+    def _send_alerts(self, user_id, alerts):
+        """إرسال تنبيهات المستخدم للواجهة (تُجمع في إطار واحد) ثم للرسائل المحفوظة"""
+        for alert_data in alerts:
+            self._send_alert({'user_id': user_id, 'alert_data': alert_data})
     
     def _send_alert(self, alert):
         """إرسال التنبيه للمستخدم"""
@@ -112,8 +927,8 @@ class AlertQueue:
         
         try:
             # إرسال للواجهة
-            socketio.emit('keyword_alert', alert_data, to=user_id)
-            socketio.emit('log_update', {
+            socket_emitter.emit('keyword_alert', alert_data, to=user_id)
+            socket_emitter.emit('log_update', {
                 "message": f"🚨 تنبيه فوري: '{alert_data['keyword']}' في {alert_data['group']}"
             }, to=user_id)
             
@@ -123,48 +938,582 @@ class AlertQueue:
         except Exception as e:
             logger.error(f"Failed to send alert for user {user_id}: {str(e)}")
     
-    def _send_to_saved_messages(self, user_id, alert_data):
-        """إرسال التنبيه للرسائل المحفوظة"""
+    def _send_seen_in(self, user_id, original, groups):
+        """تحديث تنبيه أُرسل سابقاً بعدد المحادثات التي نُشرت فيها الرسالة"""
+        seen_in = original.get('seen_in', 1)
+        # الأصل لم يُرسل بعد (أو أُرسل بالعدد الحالي في نفس الدفعة) - لا حاجة لمتابعة
+        if seen_in <= original.get('reported_seen_in', seen_in):
+            return
+        original['reported_seen_in'] = seen_in
+        
+        try:
+            if alert_store.enabled:
+                alert_store.update_seen_in(user_id, original.get('dedup_key'), seen_in)
+        except Exception as e:
+            logger.error(f"Error updating alert history: {str(e)}")
+        
         try:
-            with USERS_LOCK:
-                if user_id in USERS:
-                    client_manager = USERS[user_id].get('client_manager')
-                    if client_manager and client_manager.client:
-                        notification_msg = f"""🚨 تنبيه فوري - مراقبة شاملة للحساب
+            socket_emitter.emit('alert_seen_in', {
+                "dedup_key": original.get('dedup_key'),
+                "keyword": original['keyword'],
+                "group": groups[-1],
+                "seen_in": seen_in
+            }, to=user_id)
+            socket_emitter.emit('log_update', {
+                "message": f"📢 تنبيه '{original['keyword']}' منشور أيضاً في {', '.join(groups)} ({seen_in} محادثة)"
+            }, to=user_id)
+            self._get_delivery_worker(user_id).submit(self._format_seen_in_message(original, groups))
+        except Exception as e:
+            logger.error(f"Failed to send alert update for user {user_id}: {str(e)}")
+    
+    def _get_delivery_worker(self, user_id):
+        """الحصول على عامل التسليم الخاص بالمستخدم"""
+        with self.delivery_lock:
+            worker = self.delivery_workers.get(user_id)
+            if worker is None:
+                worker = SavedMessagesWorker(user_id)
+                self.delivery_workers[user_id] = worker
+            return worker
+    
+    def _format_saved_message(self, alert_data):
+        """بناء نص إشعار الرسائل المحفوظة"""
+        message = alert_data.get('message', '')
+        count = alert_data.get('count', 1)
+        seen_in = alert_data.get('seen_in', 1)
+        extra_lines = f"\n🔁 عدد التكرارات: {count}" if count > 1 else ""
+        if seen_in > 1:
+            extra_lines += f"\n📢 منشورة في {seen_in} محادثة"
+        if alert_data.get('backfilled'):
+            extra_lines += "\n⏪ رسالة فائتة استُدركت بعد انقطاع الاتصال"
+        return f"""🚨 تنبيه فوري - مراقبة شاملة للحساب
 
 📝 الكلمة المراقبة: {alert_data['keyword']}
 📊 المصدر: {alert_data['group']}
 👤 المرسل: {alert_data.get('sender', 'غير معروف')}
 🕐 وقت الرسالة: {alert_data.get('message_time', '')}
-🔗 معرف الرسالة: {alert_data.get('message_id', '')}
+🔗 معرف الرسالة: {alert_data.get('message_id', '')}{extra_lines}
 
 💬 نص الرسالة:
-{alert_data.get('message', '')[:500]}{'...' if len(alert_data.get('message', '')) > 500 else ''}
+{message[:500]}{'...' if len(message) > 500 else ''}
 
 --- تنبيه فوري من المراقبة الشاملة اللحظية لكامل الحساب"""
-                        
-                        # تشغيل في event loop الخاص بالعميل
-                        if hasattr(client_manager, 'run_coroutine'):
-                            client_manager.run_coroutine(
-                                client_manager.client.send_message('me', notification_msg)
-                            )
-                        
-                        logger.info(f"Alert sent to saved messages for user {user_id}")
+    
+    def _format_seen_in_message(self, original, groups):
+        """إشعار متابعة قصير لتنبيه أُرسل سابقاً"""
+        message = original.get('message', '').replace('\n', ' ')
+        return f"""📢 تحديث تنبيه سابق - نفس الرسالة نُشرت في محادثات أخرى
+
+📝 الكلمة المراقبة: {original['keyword']}
+📊 المصدر الأصلي: {original['group']}
+➕ منشورة أيضاً في: {', '.join(groups)}
+🔢 إجمالي المحادثات: {original.get('seen_in', 1)}
+💬 {message[:150]}{'...' if len(message) > 150 else ''}"""
+    
+    def _format_digest_messages(self, alerts):
+        """بناء منشور ملخص واحد (أو أكثر عند تجاوز حد طول رسالة تيليجرام)"""
+        header = f"📦 ملخص التنبيهات - {len(alerts)} تنبيه\n"
+        footer = "\n--- ملخص من المراقبة الشاملة لكامل الحساب"
+        messages = []
+        current = header
+        
+        for alert_data in alerts:
+            text = alert_data.get('message', '').replace('\n', ' ')
+            line = (
+                f"\n🔹 '{alert_data['keyword']}' في {alert_data['group']}"
+                f" | 👤 {alert_data.get('sender', 'غير معروف')}"
+                f" | 🕐 {alert_data.get('message_time', '')}"
+                f"{' | 🔁 ' + str(alert_data['count']) if alert_data.get('count', 1) > 1 else ''}"
+                f"\n💬 {text[:150]}{'...' if len(text) > 150 else ''}\n"
+            )
+            if len(current) + len(line) + len(footer) > TELEGRAM_MESSAGE_LIMIT:
+                messages.append(current + footer)
+                current = header
+            current += line
+        
+        messages.append(current + footer)
+        return messages
+    
+    def _flush_digest(self, user_id):
+        """إرسال ملخص المستخدم المعلّق إن وجد"""
+        with self.delivery_lock:
+            digest = self.digests.pop(user_id, None)
+        if not digest or not digest['alerts']:
+            return
+        
+        worker = self._get_delivery_worker(user_id)
+        for text in self._format_digest_messages(digest['alerts']):
+            worker.submit(text)
+    
+    def _flush_digests(self, force=False):
+        """إرسال الملخصات التي انتهت فترتها"""
+        now = time.monotonic()
+        with self.delivery_lock:
+            due = [
+                user_id for user_id, digest in self.digests.items()
+                if force or now >= digest['flush_at']
+            ]
+        for user_id in due:
+            self._flush_digest(user_id)
+    
+    def _send_to_saved_messages(self, user_id, alert_data):
+        """إرسال التنبيه للرسائل المحفوظة - بدون حجز USERS_LOCK أو انتظار الإرسال"""
+        try:
+            with self.delivery_lock:
+                digest_interval, digest_max_alerts = self.digest_config.get(
+                    user_id, (ALERT_DIGEST_INTERVAL, ALERT_DIGEST_MAX_ALERTS)
+                )
+                
+                # الكلمات العاجلة ووضع الإرسال الفوري تتجاوز الملخص
+                if digest_interval and not alert_data.get('urgent'):
+                    digest = self.digests.get(user_id)
+                    if digest is None:
+                        digest = {'alerts': [], 'flush_at': time.monotonic() + digest_interval}
+                        self.digests[user_id] = digest
+                    digest['alerts'].append(alert_data)
+                    if len(digest['alerts']) < digest_max_alerts:
+                        return
+                    flush_now = True
+                else:
+                    flush_now = False
+            
+            if flush_now:
+                self._flush_digest(user_id)
+                return
+            
+            notification_msg = self._format_saved_message(alert_data)
+            self._get_delivery_worker(user_id).submit(notification_msg)
         except Exception as e:
             logger.error(f"Failed to send to saved messages: {str(e)}")
 
 # إنشاء نظام التنبيهات العالمي
 alert_queue = AlertQueue()
 
+# =========================== 
+# سجل التنبيهات الدائم (SQLite + FTS5)
+# ===========================
+ALERT_STORE_BATCH_DELETE = 5000
+
+class AlertStore:
+    """سجل إلحاقي للتنبيهات مع فهرس نصي كامل وبحث بمؤشر (cursor)
+    
+    الكتابة دفعة واحدة لكل تفريغ من AlertQueue، وcreated_at هو وقت الرسالة نفسها.
+    النص المفهرس موحد بـ normalize_text حتى يطابق البحث الكتابة بتشكيل أو بدونه.
+    الاحتفاظ يحذف الأقدم من N يوم والزائد عن الحد لكل مستخدم على دفعات صغيرة
+    في thread منفصل حتى لا يؤخر تسليم التنبيهات.
+    """
+    
+    COLUMNS = ('id', 'user_id', 'created_at', 'keyword', 'chat', 'sender', 'message',
+               'message_id', 'count', 'seen_in', 'urgent', 'dedup_key')
+    
+    def __init__(self, path=ALERT_STORE_PATH, retention_days=ALERT_RETENTION_DAYS,
+                 max_per_user=ALERT_RETENTION_MAX_PER_USER, compact_interval=ALERT_COMPACT_INTERVAL):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_per_user = max_per_user
+        self.compact_interval = compact_interval
+        self.compactor = None
+        self.lock = Lock()
+        self.conn = None
+        self.fts = False
+        if path:
+            try:
+                self._open()
+            except (OSError, sqlite3.Error) as e:
+                # السجل اختياري - تعطيله أفضل من إيقاف التطبيق كله
+                logger.error(f"Alert store disabled - cannot open {path}: {str(e)}")
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                self.fts = False
+    
+    @property
+    def enabled(self):
+        return self.conn is not None
+    
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        # يجب ضبطه قبل إنشاء الجداول حتى يمكن استرجاع المساحة بعد الحذف
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS alerts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, created_at REAL NOT NULL, "
+                "keyword TEXT, chat TEXT, sender TEXT, message TEXT, message_id INTEGER, "
+                "count INTEGER NOT NULL DEFAULT 1, seen_in INTEGER NOT NULL DEFAULT 1, urgent INTEGER NOT NULL DEFAULT 0, "
+                "dedup_key TEXT)"
+            )
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(alerts)")}
+            if 'dedup_key' not in columns:
+                # قواعد أُنشئت قبل إضافة العمود
+                self.conn.execute("ALTER TABLE alerts ADD COLUMN dedup_key TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS alerts_user_id ON alerts (user_id, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS alerts_user_keyword ON alerts (user_id, keyword, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS alerts_user_chat ON alerts (user_id, chat, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS alerts_created ON alerts (created_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS alerts_user_dedup ON alerts (user_id, dedup_key)")
+        
+        try:
+            with self.conn:
+                self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS alerts_fts USING fts5(body, tokenize='unicode61')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite FTS5 is not available - alert text search falls back to LIKE")
+    
+    @staticmethod
+    def _search_body(alert_data):
+        parts = (alert_data.get('keyword'), alert_data.get('group'), alert_data.get('sender'),
+                 alert_data.get('full_message') or alert_data.get('message'))
+        return normalize_text(' '.join(str(part) for part in parts if part))
+    
+    def append_many(self, records):
+        """إضافة (user_id, alert_data) في معاملة واحدة"""
+        now = time.time()
+        rows = []
+        bodies = []
+        for user_id, alert_data in records:
+            rows.append((
+                user_id, alert_data.get('message_ts') or now, alert_data.get('keyword'), alert_data.get('group'), alert_data.get('sender'),
+                alert_data.get('full_message') or alert_data.get('message'), alert_data.get('message_id'),
+                alert_data.get('count', 1), alert_data.get('seen_in', 1), int(bool(alert_data.get('urgent'))),
+                alert_data.get('dedup_key')
+            ))
+            bodies.append(self._search_body(alert_data))
+        if not rows:
+            return
+        self._ensure_compactor()
+        
+        with self.lock, self.conn:
+            cursor = self.conn.cursor()
+            for row, body in zip(rows, bodies):
+                cursor.execute(
+                    "INSERT INTO alerts (user_id, created_at, keyword, chat, sender, message, message_id, "
+                    "count, seen_in, urgent, dedup_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row
+                )
+                if self.fts:
+                    cursor.execute("INSERT INTO alerts_fts (rowid, body) VALUES (?, ?)", (cursor.lastrowid, body))
+    
+    def update_seen_in(self, user_id, dedup_key, seen_in):
+        """تحديث عدد المحادثات لآخر تنبيه بنفس مفتاح الدمج"""
+        if not dedup_key:
+            return
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE alerts SET seen_in = ? WHERE id = ("
+                "SELECT id FROM alerts WHERE user_id = ? AND dedup_key = ? ORDER BY id DESC LIMIT 1)",
+                (seen_in, user_id, dedup_key)
+            )
+    
+    @staticmethod
+    def _fts_query(text):
+        """كل كلمة كعبارة مقتبسة - يمنع أخطاء صيغة FTS من مدخلات المستخدم"""
+        tokens = normalize_text(text).split()
+        return ' '.join('"' + token.replace('"', '""') + '"' for token in tokens)
+    
+    def search(self, user_id, keyword=None, chat=None, since=None, until=None, text=None, cursor=None, limit=50):
+        """الأحدث أولاً - يُرجع (التنبيهات، مؤشر الصفحة التالية أو None)"""
+        limit = max(1, min(int(limit), 500))
+        columns = ', '.join(f"a.{name}" for name in self.COLUMNS)
+        clauses = ["a.user_id = ?"]
+        params = [user_id]
+        source = "alerts a"
+        
+        # نص لا يبقى منه شيء بعد التوحيد (تشكيل فقط مثلاً) لا يُعد فلتراً
+        if text and normalize_text(text).strip():
+            if self.fts:
+                source = "alerts_fts f JOIN alerts a ON a.id = f.rowid"
+                clauses.append("alerts_fts MATCH ?")
+                params.append(self._fts_query(text))
+            else:
+                clauses.append("a.message LIKE ?")
+                params.append(f"%{text.strip()}%")
+        if keyword:
+            clauses.append("a.keyword = ?")
+            params.append(keyword)
+        if chat:
+            clauses.append("a.chat = ?")
+            params.append(chat)
+        if since is not None:
+            clauses.append("a.created_at >= ?")
+            params.append(float(since))
+        if until is not None:
+            clauses.append("a.created_at < ?")
+            params.append(float(until))
+        if cursor:
+            clauses.append("a.id < ?")
+            params.append(int(cursor))
+        
+        sql = f"SELECT {columns} FROM {source} WHERE {' AND '.join(clauses)} ORDER BY a.id DESC LIMIT ?"
+        params.append(limit + 1)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        
+        alerts = [dict(zip(self.COLUMNS, row)) for row in rows[:limit]]
+        for alert in alerts:
+            alert['urgent'] = bool(alert['urgent'])
+        next_cursor = str(alerts[-1]['id']) if len(rows) > limit else None
+        return alerts, next_cursor
+    
+    def _delete_ids(self, ids):
+        placeholders = ','.join('?' * len(ids))
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM alerts WHERE id IN ({placeholders})", ids)
+            if self.fts:
+                self.conn.execute(f"DELETE FROM alerts_fts WHERE rowid IN ({placeholders})", ids)
+    
+    def _delete_batches(self, select_sql, params):
+        removed = 0
+        while True:
+            with self.lock:
+                ids = [row[0] for row in self.conn.execute(select_sql, params + [ALERT_STORE_BATCH_DELETE])]
+            if not ids:
+                return removed
+            self._delete_ids(ids)
+            removed += len(ids)
+    
+    def compact(self):
+        """تطبيق سياسة الاحتفاظ ثم دمج فهرس FTS واسترجاع المساحة"""
+        removed = 0
+        if self.retention_days > 0:
+            cutoff = time.time() - self.retention_days * 86400
+            removed += self._delete_batches("SELECT id FROM alerts WHERE created_at < ? LIMIT ?", [cutoff])
+        
+        if self.max_per_user > 0:
+            with self.lock:
+                heavy = self.conn.execute(
+                    "SELECT user_id FROM alerts GROUP BY user_id HAVING COUNT(*) > ?", (self.max_per_user,)
+                ).fetchall()
+            for (user_id,) in heavy:
+                with self.lock:
+                    boundary = self.conn.execute(
+                        "SELECT id FROM alerts WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                        (user_id, self.max_per_user)
+                    ).fetchone()
+                if boundary:
+                    removed += self._delete_batches(
+                        "SELECT id FROM alerts WHERE user_id = ? AND id <= ? LIMIT ?", [user_id, boundary[0]]
+                    )
+        
+        if removed:
+            with self.lock:
+                if self.fts:
+                    with self.conn:
+                        self.conn.execute("INSERT INTO alerts_fts (alerts_fts) VALUES ('optimize')")
+                self.conn.execute("PRAGMA incremental_vacuum")
+            logger.info(f"Alert history compaction removed {removed} alerts")
+        return removed
+    
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+    
+    def _ensure_compactor(self):
+        if self.compactor is not None or self.compact_interval <= 0:
+            return
+        with self.lock:
+            if self.compactor is None:
+                self.compactor = threading.Thread(target=self._compact_loop, name="alert-store-compactor", daemon=True)
+                self.compactor.start()
+    
+    def _compact_loop(self):
+        """تطبيق سياسة الاحتفاظ دورياً - بعيداً عن thread تسليم التنبيهات"""
+        while self.enabled:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Alert history compaction failed: {str(e)}")
+
+# إنشاء سجل التنبيهات العالمي
+alert_store = AlertStore()
+
 # =========================== 
 # إدارة الجلسات والإعدادات
 # ===========================
+class JsonSettingsBackend:
+    """ملف JSON لكل مستخدم مع كتابة ذرية (ملف مؤقت ثم إعادة تسمية)"""
+    
+    def __init__(self, directory=SESSIONS_DIR):
+        self.directory = directory
+    
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+    
+    def load(self, user_id):
+        path = self._path(user_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    def load_all(self):
+        result = {}
+        for filename in os.listdir(self.directory):
+            # ملفات الكيانات المحلولة ليست إعدادات مستخدمين
+            if not filename.endswith('.json') or filename.endswith(('_peers.json', '_checkpoints.json')):
+                continue
+            user_id = filename.split('.')[0]
+            try:
+                result[user_id] = self.load(user_id)
+            except Exception as e:
+                logger.error(f"Error loading settings for {user_id}: {str(e)}")
+        return result
+    
+    def write_many(self, items):
+        for user_id, data in items:
+            path = self._path(user_id)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+class SqliteSettingsBackend:
+    """ملف SQLite واحد (WAL) لإعدادات كل المستخدمين"""
+    
+    def __init__(self, path=SETTINGS_DB_PATH):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS settings ("
+            "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+        self._import_json_files()
+    
+    def _import_json_files(self):
+        """ترحيل ملفات JSON القديمة عند أول تشغيل"""
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM settings LIMIT 1").fetchone():
+                return
+        
+        legacy = JsonSettingsBackend().load_all()
+        if legacy:
+            self.write_many(
+                (user_id, json.dumps(settings, ensure_ascii=False, separators=(',', ':')))
+                for user_id, settings in legacy.items() if settings
+            )
+            logger.info(f"Imported {len(legacy)} JSON settings files into {self.path}")
+    
+    def load(self, user_id):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM settings WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def load_all(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id, data FROM settings").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+    
+    def write_many(self, items):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO settings (user_id, data, updated_at) VALUES (?, ?, ?)",
+                [(user_id, data, now) for user_id, data in items]
+            )
+
+class SettingsStore:
+    """نسخة في الذاكرة هي المرجع، مع كتابة مؤجلة مجمّعة إلى المخزن"""
+    
+    def __init__(self, backend, flush_delay=SETTINGS_FLUSH_DELAY):
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self.cache = {}
+        self.dirty = set()
+        self.cond = threading.Condition()
+        self.thread = None
+    
+    def _start_flusher(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._flush_loop, name="settings-flusher", daemon=True)
+            self.thread.start()
+    
+    def save(self, user_id, settings):
+        """تحديث النسخة في الذاكرة وجدولة الكتابة"""
+        with self.cond:
+            self.cache[user_id] = copy.deepcopy(settings)
+            self.dirty.add(user_id)
+            self._start_flusher()
+            self.cond.notify()
+    
+    def load(self, user_id):
+        """قراءة الإعدادات من الذاكرة (أو من المخزن عند أول طلب)"""
+        with self.cond:
+            if user_id in self.cache:
+                return copy.deepcopy(self.cache[user_id])
+        
+        settings = self.backend.load(user_id) or {}
+        with self.cond:
+            self.cache.setdefault(user_id, settings)
+            return copy.deepcopy(self.cache[user_id])
+    
+    def load_all(self):
+        """تحميل كل الإعدادات مرة واحدة"""
+        loaded = self.backend.load_all()
+        with self.cond:
+            for user_id, settings in loaded.items():
+                if settings:
+                    self.cache.setdefault(user_id, settings)
+            return {user_id: copy.deepcopy(settings) for user_id, settings in self.cache.items()}
+    
+    def _flush_loop(self):
+        """انتظار التغييرات ثم كتابتها بعد فترة التجميع"""
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            time.sleep(self.flush_delay)
+            self.flush()
+    
+    def flush(self):
+        """كتابة كل الإعدادات المعدلة الآن"""
+        with self.cond:
+            items = [
+                (user_id, json.dumps(self.cache[user_id], ensure_ascii=False, separators=(',', ':')))
+                for user_id in self.dirty
+            ]
+            self.dirty.clear()
+        
+        if not items:
+            return
+        try:
+            self.backend.write_many(items)
+        except Exception as e:
+            logger.error(f"Error flushing settings: {str(e)}")
+            with self.cond:
+                self.dirty.update(user_id for user_id, _ in items)
+
+def create_settings_store():
+    """إنشاء مخزن الإعدادات حسب SETTINGS_BACKEND"""
+    if SETTINGS_BACKEND == 'sqlite':
+        backend = SqliteSettingsBackend()
+    else:
+        backend = JsonSettingsBackend()
+    return SettingsStore(backend)
+
+settings_store = create_settings_store()
+atexit.register(settings_store.flush)
+
 def save_settings(user_id, settings):
     """حفظ إعدادات المستخدم"""
     try:
-        path = os.path.join(SESSIONS_DIR, f"{user_id}.json")
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(settings, f, ensure_ascii=False, indent=4)
+        settings_store.save(user_id, settings)
+        
+        # حل مجموعات الإرسال مسبقاً في الخلفية حتى لا يدفع أول إرسال ثمنها
+        client_manager = telegram_manager.client_managers.get(user_id)
+        if client_manager and client_manager.authorized and settings.get('groups'):
+            client_manager.prefetch_peers(settings['groups'])
         return True
     except Exception as e:
         logger.error(f"Error saving settings for {user_id}: {str(e)}")
@@ -173,50 +1522,813 @@ def save_settings(user_id, settings):
 def load_settings(user_id):
     """تحميل إعدادات المستخدم"""
     try:
-        path = os.path.join(SESSIONS_DIR, f"{user_id}.json")
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        return {}
+        return settings_store.load(user_id)
     except Exception as e:
         logger.error(f"Error loading settings for {user_id}: {str(e)}")
         return {}
 
-def load_all_sessions():
-    """تحميل جميع الجلسات الموجودة"""
+def freeze_settings(settings):
+    """لقطة إعدادات غير قابلة للتعديل (القوائم تصبح tuples)"""
+    return MappingProxyType({
+        key: tuple(value) if isinstance(value, list) else value
+        for key, value in dict(settings or {}).items()
+    })
+
+def thaw_settings(snapshot):
+    """نسخة dict عادية قابلة للتعديل والحفظ من لقطة الإعدادات"""
+    return {
+        key: list(value) if isinstance(value, tuple) else value
+        for key, value in snapshot.items()
+    }
+
+class UserState:
+    """حالة مستخدم واحد بقفل خاص ولقطة إعدادات تُستبدل ذرياً"""
+    
+    __slots__ = (
+        'user_id', 'lock', 'client_manager', 'settings', 'thread', 'is_running', 'stats',
+        'connected', 'authenticated', 'awaiting_code', 'awaiting_password', 'phone_code_hash',
+        'monitoring_active', 'event_handlers_registered', 'last_scheduled_send'
+    )
+    
+    def __init__(self, user_id, settings=None):
+        self.user_id = user_id
+        self.lock = Lock()
+        self.client_manager = None
+        self.settings = freeze_settings(settings)
+        self.thread = None
+        self.is_running = False
+        self.stats = {"sent": 0, "errors": 0}
+        self.connected = False
+        self.authenticated = False
+        self.awaiting_code = False
+        self.awaiting_password = False
+        self.phone_code_hash = None
+        self.monitoring_active = False
+        self.event_handlers_registered = False
+        self.last_scheduled_send = 0
+    
+    def update(self, **fields):
+        """تحديث عدة حقول معاً تحت قفل المستخدم"""
+        with self.lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+    
+    def update_settings(self, **changes):
+        """تعديل مفاتيح في الإعدادات وإرجاع نسخة dict للحفظ"""
+        with self.lock:
+            settings = thaw_settings(self.settings)
+            settings.update(changes)
+            self.settings = freeze_settings(settings)
+        return settings
+    
+    def add_stats(self, sent=0, errors=0):
+        """زيادة الإحصائيات"""
+        with self.lock:
+            self.stats = {"sent": self.stats["sent"] + sent, "errors": self.stats["errors"] + errors}
+
+def load_all_sessions(reconnect=AUTO_RECONNECT):
+    """تحميل جميع الجلسات الموجودة - القراءة من القرص تتم خارج USERS_LOCK"""
     logger.info("Loading existing sessions...")
-    session_count = 0
     
+    try:
+        all_settings = settings_store.load_all()
+    except Exception as e:
+        logger.error(f"Error loading sessions: {str(e)}")
+        return 0
+    
+    entries = {
+        user_id: UserState(user_id, settings)
+        for user_id, settings in all_settings.items()
+        if settings and 'phone' in settings and shard_ring.owns(user_id)
+    }
+    
+    # القفل يغطي إدراج السجلات فقط
     with USERS_LOCK:
+        for user_id, entry in entries.items():
+            USERS.setdefault(user_id, entry)
+    
+    session_count = len(entries)
+    if shard_ring.distributed:
+        logger.info(f"Shard {shard_ring.shard_id}/{shard_ring.shard_count} owns {session_count} sessions")
+    logger.info(f"Loaded {session_count} sessions successfully")
+    
+    if reconnect and session_count:
+        session_reconnector.start(list(entries))
+    return session_count
+
+# =========================== 
+# بث حالة المستخدمين للوحة الأدمن
+# ===========================
+def admin_user_view(state):
+    """الحقول التي تعرضها لوحة الأدمن لكل مستخدم"""
+    settings = state.settings
+    return {
+        "phone": settings.get('phone'),
+        "send_type": settings.get('send_type', 'manual'),
+        "groups_count": len(settings.get('groups', ())),
+        "connected": state.connected,
+        "authenticated": state.authenticated,
+        "is_running": state.is_running,
+        "monitoring_active": state.monitoring_active,
+        "stats": dict(state.stats)
+    }
+
+# إعدادات المستخدم التي تعرضها نافذة التفاصيل في لوحة الأدمن
+ADMIN_SETTINGS_FIELDS = (
+    'phone', 'send_type', 'groups', 'interval_seconds', 'watch_words', 'urgent_words', 'monitoring_enabled'
+)
+
+def admin_user_details(state):
+    """حقول العرض مع الإعدادات المعروضة فقط - بدون phone_code_hash أو حالة تسجيل الدخول"""
+    settings = state.settings
+    view = admin_user_view(state)
+    view["settings"] = thaw_settings({name: settings[name] for name in ADMIN_SETTINGS_FIELDS if name in settings})
+    return view
+
+class AdminFeed:
+    """لقطة أولية ثم فروقات مرقّمة بالإصدار لكل مستخدم تغيّرت حالته
+    
+    المقارنة تتم على الخادم مرة كل ADMIN_FEED_INTERVAL وفقط أثناء وجود أدمن متصل.
+    """
+    
+    NAMESPACE = '/admin'
+    
+    def __init__(self, interval=ADMIN_FEED_INTERVAL):
+        self.interval = interval
+        self.version = 0
+        self.views = {}
+        self.listeners = 0
+        self.lock = Lock()
+        self.started = False
+    
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        socketio.start_background_task(self._feed_loop)
+    
+    def admin_joined(self):
+        with self.lock:
+            self.listeners += 1
+    
+    def admin_left(self):
+        with self.lock:
+            self.listeners = max(0, self.listeners - 1)
+    
+    def _collect(self):
+        """مقارنة الحالة الحالية بآخر ما تم بثه - يُستدعى تحت self.lock"""
+        current = {user_id: admin_user_view(state) for user_id, state in list(USERS.items())}
+        changed = {
+            user_id: view for user_id, view in current.items()
+            if self.views.get(user_id) != view
+        }
+        removed = [user_id for user_id in self.views if user_id not in current]
+        if not changed and not removed:
+            return None
+        
+        base = self.version
+        self.version += 1
+        self.views = current
+        return {
+            "shard": shard_ring.shard_id, "version": self.version, "base": base,
+            "changed": changed, "removed": removed
+        }
+    
+    def has_listeners(self):
+        # في النشر الموزع قد يكون الأدمن متصلاً بجزء آخر ويستقبل عبر وسيط الرسائل
+        return self.listeners > 0 or shard_ring.distributed
+    
+    def sync(self):
+        """تحديث الإصدار وبث الفرق إن وُجد - يُرجع رقم الإصدار الحالي"""
+        with self.lock:
+            delta = self._collect()
+            version = self.version
+        if delta and self.has_listeners():
+            socketio.emit('users_delta', delta, namespace=self.NAMESPACE)
+        return version
+    
+    def snapshot(self):
+        """اللقطة الكاملة التي يبدأ منها الأدمن عند الاتصال"""
+        self.sync()
+        with self.lock:
+            return {
+                "shard": shard_ring.shard_id, "shards": shard_ring.shard_count,
+                "version": self.version, "users": dict(self.views)
+            }
+    
+    def _feed_loop(self):
+        while True:
+            socketio.sleep(self.interval)
+            if not self.has_listeners():
+                continue
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Admin feed error: {str(e)}")
+
+# إنشاء بث الأدمن العالمي
+admin_feed = AdminFeed()
+
+# =========================== 
+# مطابقة الكلمات المفتاحية المُجمّعة (Aho–Corasick)
+# ===========================
+# التشكيل والتطويل وعلامات القرآن تُحذف قبل المطابقة
+ARABIC_DIACRITICS_RE = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+
+# توحيد أشكال الألف والياء والتاء المربوطة
+ARABIC_CHAR_MAP = str.maketrans({
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ى': 'ي',
+    'ی': 'ي',
+    'ة': 'ه',
+    'ک': 'ك',
+})
+
+def normalize_text(text):
+    """توحيد النص (NFKC + casefold + إزالة التشكيل + توحيد الحروف العربية)"""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = ARABIC_DIACRITICS_RE.sub('', text)
+    return text.translate(ARABIC_CHAR_MAP)
+
+class KeywordMatcher:
+    """مطابق كلمات متعددة يُبنى مرة واحدة ويفحص الرسالة في مسح واحد"""
+    
+    def __init__(self, keywords=()):
+        self.keywords = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        
+        patterns = {}
+        for keyword in keywords:
+            keyword = keyword.strip()
+            pattern = normalize_text(keyword)
+            if pattern and pattern not in patterns:
+                patterns[pattern] = len(self.keywords)
+                self.keywords.append(keyword)
+        
+        for pattern, index in patterns.items():
+            self._add_pattern(pattern, index)
+        self._build_failure_links()
+    
+    def __len__(self):
+        return len(self.keywords)
+    
+    def _add_pattern(self, pattern, index):
+        """إضافة نمط إلى شجرة الحالات"""
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (index,)
+    
+    def _build_failure_links(self):
+        """بناء روابط الفشل بالعرض أولاً ودمج المخرجات"""
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+    
+    def find_all(self, text):
+        """إرجاع كل الكلمات المطابقة في النص بترتيب إدخالها"""
+        if not self.keywords or not text:
+            return []
+        
+        goto, fail, out = self._goto, self._fail, self._out
+        total = len(self.keywords)
+        found = set()
+        state = 0
+        
+        for char in normalize_text(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+                if len(found) == total:
+                    break
+        
+        return [self.keywords[index] for index in sorted(found)]
+
+# =========================== 
+# تصفية الرسائل قبل المعالجة (قواعد المحادثات ونوع الرسالة)
+# ===========================
+MESSAGE_CHAT_KINDS = ('private', 'group', 'channel')
+MESSAGE_DIRECTIONS = ('all', 'incoming', 'outgoing')
+
+class MessageFilter:
+    """قواعد السماح/الحظر لكل مستخدم مُجمّعة في مجموعات أرقام وأعلام
+    
+    تُفحص في بداية المعالجة قبل أي await أو معالجة نصوص، وتقرأ فقط
+    حقولاً متاحة في التحديث نفسه (chat_id ونوع المحادثة والاتجاه والوسائط).
+    
+    مفاتيح الإعدادات:
+    filter_allow_chats: أرقام محادثات - إن وُجدت لا يُراقب غيرها
+    filter_deny_chats: أرقام محادثات تُتجاهل دائماً
+    filter_chat_kinds: أي من private / group / channel (الافتراضي الكل)
+    filter_direction: all / incoming / outgoing
+    filter_skip_media: تجاهل الرسائل التي تحمل وسائط
+    """
+    
+    __slots__ = ('allow_chats', 'deny_chats', 'kinds', 'direction', 'skip_media')
+    
+    def __init__(self, allow_chats=(), deny_chats=(), kinds=MESSAGE_CHAT_KINDS, direction='all', skip_media=False):
+        self.allow_chats = frozenset(allow_chats)
+        self.deny_chats = frozenset(deny_chats)
+        self.kinds = frozenset(kinds)
+        self.direction = direction
+        self.skip_media = skip_media
+    
+    @staticmethod
+    def _chat_ids(values):
+        chat_ids = set()
+        for value in values or ():
+            try:
+                chat_ids.add(int(str(value).strip()))
+            except ValueError:
+                logger.warning(f"Ignoring non-numeric chat id in message filter: {value}")
+        return chat_ids
+    
+    @classmethod
+    def from_settings(cls, settings):
+        """بناء المُصفي من الإعدادات - None إن لم تكن هناك قواعد (مراقبة كل شيء)"""
+        kinds = [kind for kind in settings.get('filter_chat_kinds', ()) if kind in MESSAGE_CHAT_KINDS]
+        direction = settings.get('filter_direction', 'all')
+        if direction not in MESSAGE_DIRECTIONS:
+            direction = 'all'
+        
+        message_filter = cls(
+            allow_chats=cls._chat_ids(settings.get('filter_allow_chats')),
+            deny_chats=cls._chat_ids(settings.get('filter_deny_chats')),
+            kinds=kinds or MESSAGE_CHAT_KINDS,
+            direction=direction,
+            skip_media=bool(settings.get('filter_skip_media', False))
+        )
+        return None if message_filter.accepts_everything() else message_filter
+    
+    def accepts_everything(self):
+        return (
+            not self.allow_chats and not self.deny_chats and len(self.kinds) == len(MESSAGE_CHAT_KINDS)
+            and self.direction == 'all' and not self.skip_media
+        )
+    
+    def accepts(self, event):
+        """فحص متزامن رخيص - False يعني تجاهل التحديث فوراً"""
+        chat_id = event.chat_id
+        if chat_id in self.deny_chats:
+            return False
+        if self.allow_chats and chat_id not in self.allow_chats:
+            return False
+        
+        if self.direction != 'all' and (self.direction == 'outgoing') != bool(event.out):
+            return False
+        if self.skip_media and event.message.media is not None:
+            return False
+        
+        if len(self.kinds) < len(MESSAGE_CHAT_KINDS):
+            if event.is_private:
+                kind = 'private'
+            elif event.is_group:
+                kind = 'group'
+            else:
+                kind = 'channel'
+            if kind not in self.kinds:
+                return False
+        return True
+
+# =========================== 
+# دمج التنبيهات المكررة (رسائل منشورة في عدة مجموعات)
+# ===========================
+# الرابط يُختصر إلى المضيف والمسار (بدون البروتوكول ومعاملات التتبع)
+DEDUP_URL_PATTERN = re.compile(r'https?://([^\s/?#]+)([^\s?#]*)\S*')
+DEDUP_NOISE_PATTERN = re.compile(r'[^\w]+')
+DEDUP_CHATS_LIMIT = 256
+
+class AlertDeduplicator:
+    """نافذة زمنية (LRU + TTL بسعة محدودة) لكل مستخدم تطوي نسخ نفس الرسالة في التنبيه الأول
+    
+    المفتاح: hash المحتوى بعد التوحيد (الروابط مضيف ومسار فقط، بدون رموز ومسافات) + الكلمة المطابقة.
+    رسالة لا يبقى منها شيء بعد التوحيد (رموز تعبيرية فقط مثلاً) لا تُدمج.
+    يُستدعى من حلقة العميل فقط لذلك لا يحتاج قفلاً.
+    """
+    
+    def __init__(self, window=ALERT_DEDUP_WINDOW, max_entries=ALERT_DEDUP_MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+    
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_entries > 0
+    
+    @staticmethod
+    def content_key(text, keyword):
+        """مفتاح الدمج أو None إن لم يبق محتوى يميز الرسالة"""
+        content = DEDUP_URL_PATTERN.sub(r' \1\2 ', normalize_text(text))
+        content = DEDUP_NOISE_PATTERN.sub(' ', content).strip()
+        if not content:
+            return None
+        digest = hashlib.blake2b(content.encode('utf-8'), digest_size=8)
+        digest.update(b'\0' + normalize_text(keyword).encode('utf-8'))
+        return digest.hexdigest()
+    
+    def fold(self, key, chat_id, alert_data):
+        """(None, False) إن كان التنبيه جديداً (ويُحفظ كأصل)، وإلا (التنبيه الأصلي، هل هي محادثة جديدة)"""
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None and now - entry[0] > self.window:
+            del self.entries[key]
+            entry = None
+        
+        if entry is None:
+            self.entries[key] = (now, {chat_id}, alert_data)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return None, False
+        
+        _, chats, original = entry
+        self.entries.move_to_end(key)
+        if chat_id in chats or len(chats) >= DEDUP_CHATS_LIMIT:
+            return original, False
+        
+        chats.add(chat_id)
+        # استبدال قيمة مفتاح موجود فقط - التنبيه قد يُسلسل في thread آخر
+        original['seen_in'] = len(chats)
+        return original, True
+
+# =========================== 
+# ذاكرة مؤقتة للكيانات (LRU + TTL)
+# ===========================
+class EntityCache:
+    """ذاكرة مؤقتة محدودة الحجم مع انتهاء صلاحية للكيانات المحلولة"""
+    
+    def __init__(self, max_size=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        """جلب قيمة من الذاكرة أو None عند عدم وجودها أو انتهاء صلاحيتها"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key, value):
+        """تخزين قيمة مع إخراج الأقدم عند امتلاء الذاكرة"""
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        """مسح الذاكرة"""
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self):
+        """إحصائيات الإصابة والإخفاق لتحديد حجم الذاكرة"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# =========================== 
+# تنظيم وتيرة الإرسال (Token Bucket)
+# ===========================
+class TokenBucket:
+    """دلو رموز غير حاجز لكل حساب - ينظم وتيرة الإرسال داخل event loop"""
+    
+    def __init__(self, rate=SEND_RATE_PER_SECOND, capacity=SEND_BURST):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def pause(self, seconds):
+        """إيقاف الإرسال للحساب كاملاً (FloodWait) وتفريغ الدلو"""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated_at = max(now, self.paused_until)
+    
+    async def acquire(self):
+        """انتظار رمز متاح دون حجز أي thread"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# =========================== 
+# تسجيل تدفق الرسائل (capture) لإعادة التشغيل
+# ===========================
+CAPTURE_DIGITS_PATTERN = re.compile(r'\d')
+CAPTURE_WORD_PATTERN = re.compile(r'\w')
+
+def redact_text(text, mode=CAPTURE_REDACT):
+    """إخفاء محتوى الرسالة قبل التسجيل
+    
+    digits: الأرقام فقط (أرقام الهواتف والحسابات) - المطابقة تبقى ممكنة عند الإعادة
+    text: كل الحروف - يُحفظ طول الرسالة وشكل التدفق فقط
+    """
+    if not text or mode == 'none':
+        return text
+    if mode == 'digits':
+        return CAPTURE_DIGITS_PATTERN.sub('0', text)
+    return CAPTURE_WORD_PATTERN.sub('x', text)
+
+class CaptureRecorder:
+    """كتابة الرسائل الواردة لملف إلحاقي لكل مستخدم: سطر JSON مضغوط لكل رسالة
+    
+    السطر: [وقت الوصول, chat_id, sender_id, message_id, النص]
+    الكتابة تتم في thread منفصل حتى لا يتأخر معالج الرسائل.
+    """
+    
+    def __init__(self, directory=CAPTURE_DIR, redact=CAPTURE_REDACT, flush_interval=CAPTURE_FLUSH_INTERVAL):
+        self.directory = directory
+        self.redact = redact
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=100000)
+        self.dropped = 0
+        self.thread = None
+        self.lock = Lock()
+    
+    @property
+    def enabled(self):
+        return bool(self.directory)
+    
+    def path_for(self, user_id):
+        return os.path.join(self.directory, f"{user_id}_{time.strftime('%Y%m%d')}.capture.jsonl")
+    
+    def record(self, user_id, event):
+        """تسجيل رسالة - غير حاجز، يتجاهل الرسالة إن امتلأت القائمة"""
+        message = event.message
+        entry = [
+            round(time.time(), 3), event.chat_id, event.sender_id, message.id,
+            redact_text(message.text or '', self.redact)
+        ]
         try:
-            for filename in os.listdir(SESSIONS_DIR):
-                if filename.endswith('.json'):
-                    user_id = filename.split('.')[0]
-                    settings = load_settings(user_id)
-                    
-                    if settings and 'phone' in settings:
-                        USERS[user_id] = {
-                            'client_manager': None,
-                            'settings': settings,
-                            'thread': None,
-                            'is_running': False,
-                            'stats': {"sent": 0, "errors": 0},
-                            'connected': False,
-                            'authenticated': False,
-                            'awaiting_code': False,
-                            'awaiting_password': False,
-                            'phone_code_hash': None,
-                            'monitoring_active': False,
-                            'event_handlers_registered': False
-                        }
-                        session_count += 1
-                        logger.info(f"✓ Loaded session for {user_id}")
+            self.queue.put_nowait((user_id, entry))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_started()
+    
+    def _ensure_started(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.thread = threading.Thread(target=self._write_loop, name="capture-writer", daemon=True)
+                self.thread.start()
+    
+    def _write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Capture write error: {str(e)}")
+    
+    def flush(self):
+        """إلحاق كل ما في القائمة بملفات المستخدمين"""
+        per_user = {}
+        while True:
+            try:
+                user_id, entry = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            per_user.setdefault(user_id, []).append(
+                json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+            )
         
+        for user_id, lines in per_user.items():
+            with open(self.path_for(user_id), "a", encoding="utf-8") as f:
+                f.write('\n'.join(lines) + '\n')
+
+def read_capture(path):
+    """قراءة ملف capture: (وقت الوصول, chat_id, sender_id, message_id, النص) لكل سطر سليم"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                timestamp, chat_id, sender_id, message_id, text = json.loads(line)
+            except (ValueError, TypeError):
+                # سطر أخير مقطوع بعد توقف مفاجئ
+                continue
+            yield timestamp, chat_id, sender_id, message_id, text
+
+# إنشاء المسجل العالمي
+capture_recorder = CaptureRecorder()
+atexit.register(lambda: capture_recorder.enabled and capture_recorder.flush())
+
+# =========================== 
+# بيئة تشغيل asyncio المشتركة للعملاء
+# ===========================
+class ClientRuntime:
+    """مجموعة ثابتة من event loops يتوزع عليها كل العملاء حسب user_id"""
+    
+    def __init__(self, size=CLIENT_LOOP_THREADS):
+        self.size = max(1, size)
+        self.loops = []
+        self.threads = []
+        self.lock = Lock()
+    
+    def _ensure_started(self):
+        """تشغيل الـ loops عند أول استخدام"""
+        if self.loops:
+            return
+        
+        with self.lock:
+            if self.loops:
+                return
+            
+            loops = []
+            for index in range(self.size):
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=self._run_loop, args=(loop,), name=f"client-loop-{index}", daemon=True
+                )
+                thread.start()
+                loops.append(loop)
+                self.threads.append(thread)
+            self.loops = loops
+            logger.info(f"Client runtime started with {self.size} event loops")
+    
+    def _run_loop(self, loop):
+        """تشغيل loop واحد إلى الأبد"""
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+    
+    def loop_for(self, user_id):
+        """اختيار loop ثابت للمستخدم (توزيع حسب hash المعرف)"""
+        self._ensure_started()
+        return self.loops[zlib.crc32(str(user_id).encode('utf-8')) % self.size]
+    
+    def stats(self):
+        """عدد الـ loops والـ threads الحية"""
+        return {
+            'loops': len(self.loops),
+            'threads_alive': sum(1 for thread in self.threads if thread.is_alive())
+        }
+
+# إنشاء بيئة التشغيل المشتركة
+client_runtime = ClientRuntime()
+
+# =========================== 
+# تخزين الكيانات المحلولة (InputPeer) للإرسال
+# ===========================
+def serialize_input_peer(peer):
+    """تحويل InputPeer إلى dict قابل للحفظ"""
+    if isinstance(peer, InputPeerChannel):
+        return {'type': 'channel', 'id': peer.channel_id, 'access_hash': peer.access_hash}
+    if isinstance(peer, InputPeerChat):
+        return {'type': 'chat', 'id': peer.chat_id}
+    if isinstance(peer, InputPeerUser):
+        return {'type': 'user', 'id': peer.user_id, 'access_hash': peer.access_hash}
+    if isinstance(peer, InputPeerSelf):
+        return {'type': 'self'}
+    return None
+
+def deserialize_input_peer(data):
+    """إعادة بناء InputPeer من dict محفوظ"""
+    peer_type = data.get('type')
+    if peer_type == 'channel':
+        return InputPeerChannel(channel_id=data['id'], access_hash=data['access_hash'])
+    if peer_type == 'chat':
+        return InputPeerChat(chat_id=data['id'])
+    if peer_type == 'user':
+        return InputPeerUser(user_id=data['id'], access_hash=data['access_hash'])
+    if peer_type == 'self':
+        return InputPeerSelf()
+    return None
+
+# =========================== 
+# نقاط التفتيش لكل محادثة واستدراك الرسائل الفائتة
+# ===========================
+class ChatCheckpoints:
+    """آخر رسالة معالجة في كل محادثة (chat_id -> message_id)
+    
+    التحديث من معالج الرسائل مجرد إسناد في dict؛ الحفظ على القرص دوري
+    ويتم خارج الـ loop. يُحتفظ بأحدث المحادثات نشاطاً فقط (LRU).
+    """
+    
+    def __init__(self, path, max_chats=CHECKPOINT_MAX_CHATS):
+        self.path = path
+        self.max_chats = max_chats
+        self.ids = OrderedDict()
+        self.dirty = False
+        self._load()
+    
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for chat_id, message_id in json.load(f).items():
+                        self.ids[int(chat_id)] = int(message_id)
         except Exception as e:
-            logger.error(f"Error loading sessions: {str(e)}")
+            logger.error(f"Error loading checkpoints from {self.path}: {str(e)}")
     
-    logger.info(f"Loaded {session_count} sessions successfully")
-    return session_count
+    def __len__(self):
+        return len(self.ids)
+    
+    def get(self, chat_id):
+        return self.ids.get(chat_id)
+    
+    def advance(self, chat_id, message_id):
+        """تقديم نقطة المحادثة - لا تتراجع أبداً (الرسائل المستدركة قد تصل بعد الحية)"""
+        if chat_id is None or message_id is None:
+            return
+        current = self.ids.get(chat_id)
+        if current is not None and message_id <= current:
+            return
+        self.ids[chat_id] = message_id
+        self.ids.move_to_end(chat_id)
+        if len(self.ids) > self.max_chats:
+            self.ids.popitem(last=False)
+        self.dirty = True
+    
+    def dump(self):
+        """لقطة JSON للحفظ (تُؤخذ على الـ loop) أو None إن لم يتغير شيء"""
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return json.dumps({str(chat_id): message_id for chat_id, message_id in self.ids.items()})
+    
+    def write(self, data):
+        """كتابة ذرية للقطة - تُستدعى من executor"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+class BackfillEvent:
+    """رسالة مستدركة بواجهة events.NewMessage التي يستخدمها معالج الرسائل
+    
+    رسائل Telethon تحمل chat_id وsender_id وget_chat() ونوع المحادثة مثل الحدث،
+    فيكفي إضافة event.message.
+    """
+    
+    __slots__ = ('message',)
+    
+    def __init__(self, message):
+        self.message = message
+    
+    def __getattr__(self, name):
+        return getattr(self.message, name)
 
 # =========================== 
 # مدير التليجرام المحسن مع Event Handlers
@@ -226,69 +2338,231 @@ class TelegramClientManager:
     
     def __init__(self, user_id):
         self.user_id = user_id
+        self.metric_label = metric_user_label(user_id)
         self.client = None
         self.loop = None
-        self.thread = None
-        self.stop_flag = threading.Event()
+        self.task = None
+        self.stop_event = None
         self.is_ready = threading.Event()
         self.event_handlers_registered = False
         self.monitored_keywords = []
         self.monitored_groups = []
+        self.urgent_keywords = frozenset()
+        self.keyword_matcher = KeywordMatcher()
+        self.message_filter = None
+        self.alert_dedup = AlertDeduplicator()
+        self.chat_cache = EntityCache()
+        self.sender_cache = EntityCache()
+        self.authorized = None
+        self.send_bucket = TokenBucket()
+        self.peers_file = os.path.join(SESSIONS_DIR, f"{user_id}_peers.json")
+        self.peer_cache = self._load_peer_cache()
+        self.checkpoints = ChatCheckpoints(os.path.join(SESSIONS_DIR, f"{user_id}_checkpoints.json"))
+        self.catch_up_pending = False
+        self.catch_up_future = None
+        self.checkpoint_flush = None
     
     def start_client_thread(self):
-        """بدء thread منفصل للعميل"""
-        if self.thread and self.thread.is_alive():
+        """تشغيل العميل على event loop المشترك الخاص بمجموعته"""
+        if self.task and not self.task.done():
             return
         
-        self.stop_flag.clear()
         self.is_ready.clear()
-        self.thread = threading.Thread(target=self._run_client_loop, daemon=True)
-        self.thread.start()
+        self.loop = client_runtime.loop_for(self.user_id)
+        self.task = asyncio.run_coroutine_threadsafe(self._client_main(), self.loop)
+        self.task.add_done_callback(lambda _: self.is_ready.set())
         
         # انتظار حتى يصبح العميل جاهزاً
         if not self.is_ready.wait(timeout=30):
             raise Exception("Client initialization timeout")
+        if self.task.done():
+            raise Exception("Client initialization failed")
     
-    def _run_client_loop(self):
-        """تشغيل event loop للعميل"""
+    async def _client_main(self):
+        """الوظيفة الرئيسية للعميل - تنتظر إشارة الإيقاف بدل الاستطلاع"""
+        self.stop_event = asyncio.Event()
+        stop_wait = None
         try:
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-            
-            session_file = os.path.join(SESSIONS_DIR, f"{self.user_id}_session.session")
-            if API_ID and API_HASH:
-                self.client = TelegramClient(session_file, int(API_ID), API_HASH)
-            else:
+            if not API_ID or not API_HASH:
                 logger.error("API_ID or API_HASH not set")
                 return
             
-            self.loop.run_until_complete(self._client_main())
+            # إنشاء العميل داخل الـ loop المشترك حتى يرتبط به
+            session_file = os.path.join(SESSIONS_DIR, f"{self.user_id}_session.session")
+            self.client = TelegramClient(session_file, int(API_ID), API_HASH)
+            self.event_handlers_registered = False
+            
+            await self.client.connect()
+            self.authorized = await self.client.is_user_authorized()
+            # الاستدراك ينتظر ضبط الكلمات المراقبة (update_monitoring_settings)
+            self.catch_up_pending = bool(self.authorized)
+            self.is_ready.set()
+            
+            # تسجيل event handlers
+            await self._register_event_handlers()
+            
+            # الحفاظ على الاتصال حتى طلب الإيقاف، وإعادته إن انقطع نهائياً
+            stop_wait = asyncio.ensure_future(self.stop_event.wait())
+            while not self.stop_event.is_set():
+                disconnected = self.client.disconnected
+                disconnected.add_done_callback(self._log_disconnect)
+                await asyncio.wait({stop_wait, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not self.stop_event.is_set():
+                    await self._reconnect()
         
         except Exception as e:
-            logger.error(f"Client thread error for {self.user_id}: {str(e)}")
-        finally:
-            if self.loop:
-                self.loop.close()
+            logger.error(f"Client main error for {self.user_id}: {str(e)}")
+        finally:
+            if stop_wait is not None and not stop_wait.done():
+                stop_wait.cancel()
+            if self.checkpoint_flush is not None:
+                self.checkpoint_flush.cancel()
+                self.checkpoint_flush = None
+            await self._flush_checkpoints()
+            if self.client:
+                await self.client.disconnect()
+    
+    def _log_disconnect(self, future):
+        """قراءة سبب الانقطاع حتى لا يبقى استثناء المستقبل غير مسترجع"""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.warning(f"Telegram connection lost for {self.user_id}: {error!r}")
+    
+    async def _reconnect(self):
+        """استنفد Telethon محاولات إعادة الاتصال - نعيد الاتصال بتراجع أسي ثم نستدرك ما فات"""
+        delay = RECONNECT_BACKOFF
+        while not self.stop_event.is_set():
+            try:
+                await self.client.connect()
+            except Exception as e:
+                logger.warning(f"Reconnect failed for {self.user_id}, retrying in {delay:.0f}s: {str(e)}")
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, 300)
+                continue
+            
+            logger.info(f"Client reconnected for {self.user_id}")
+            self.catch_up_pending = bool(self.authorized)
+            self.request_catch_up()
+            return
+    
+    def _schedule_checkpoint_flush(self):
+        """حفظ مؤجل لنقاط التفتيش - مؤقت واحد لكل دفعة تغييرات بدل الإيقاظ الدوري"""
+        if self.checkpoint_flush is None:
+            self.checkpoint_flush = asyncio.get_running_loop().call_later(
+                CHECKPOINT_FLUSH_INTERVAL, self._on_checkpoint_timer
+            )
+    
+    def _on_checkpoint_timer(self):
+        self.checkpoint_flush = None
+        asyncio.ensure_future(self._flush_checkpoints())
+    
+    async def _flush_checkpoints(self):
+        """حفظ نقاط التفتيش إن تغيرت - الكتابة خارج الـ loop"""
+        data = self.checkpoints.dump()
+        if data is None:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.checkpoints.write, data)
+        except Exception as e:
+            self.checkpoints.dirty = True
+            logger.error(f"Error saving checkpoints for {self.user_id}: {str(e)}")
+    
+    def request_catch_up(self):
+        """بدء استدراك واحد لكل اتصال لمستخدم يراقب فعلياً وكلماته معروفة
+        
+        بدون كلمات يُنبَّه على كل رسالة، فاستدراك الانقطاع سيغرق المستخدم - يُؤجل حتى ضبطها.
+        يبقى الطلب معلقاً حتى يستدعيه monitoring_worker عند بدء المراقبة.
+        """
+        if not CATCHUP_ENABLED or not self.catch_up_pending or not self.monitored_keywords:
+            return
+        user = USERS.get(self.user_id)
+        if not user or not user.monitoring_active:
+            return
+        if self.catch_up_future is not None and not self.catch_up_future.done():
+            return
+        self.catch_up_pending = False
+        try:
+            self.catch_up_future = self.submit_coroutine(self._catch_up())
+        except Exception as e:
+            logger.error(f"Could not start catch-up for {self.user_id}: {str(e)}")
     
-    async def _client_main(self):
-        """الوظيفة الرئيسية للعميل"""
-        try:
-            if self.client:
-                await self.client.connect()
-                self.is_ready.set()
-                
-                # تسجيل event handlers
-                await self._register_event_handlers()
-                
-                # الحفاظ على الاتصال
-                while not self.stop_flag.is_set():
-                    await asyncio.sleep(1)
+    async def _catch_up(self):
+        """جلب الرسائل الفائتة منذ آخر نقطة تفتيش وتمريرها بنفس مسار المعالجة
+        
+        المحادثات المرشحة من أول CATCHUP_MAX_CHATS حواراً (الأحدث نشاطاً، 100 لكل طلب)
+        التي تتجاوز رسالتها الأخيرة نقطة التفتيش؛ الجلب بتوازي CATCHUP_CONCURRENCY
+        وبميزانية إجمالية CATCHUP_MAX_MESSAGES رسالة.
+        """
+        if not len(self.checkpoints):
+            return
+        started = time.perf_counter()
+        cutoff = time.time() - CATCHUP_MAX_AGE
         
+        pending = []
+        try:
+            async for dialog in self.client.iter_dialogs(limit=CATCHUP_MAX_CHATS):
+                last_id = self.checkpoints.get(dialog.id)
+                top = dialog.message
+                if last_id is None or top is None or top.id <= last_id:
+                    continue
+                if top.date is not None and top.date.timestamp() < cutoff:
+                    continue
+                pending.append((dialog, last_id))
         except Exception as e:
-            logger.error(f"Client main error: {str(e)}")
-        finally:
-            if self.client:
-                await self.client.disconnect()
+            logger.error(f"Catch-up dialog scan failed for {self.user_id}: {str(e)}")
+            return
+        if not pending:
+            return
+        
+        budget = {'remaining': CATCHUP_MAX_MESSAGES}
+        semaphore = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+        counts = await asyncio.gather(*(
+            self._catch_up_chat(dialog, last_id, cutoff, budget, semaphore) for dialog, last_id in pending
+        ))
+        total = sum(counts)
+        elapsed = time.perf_counter() - started
+        CATCHUP_MESSAGES_TOTAL.inc(total, (self.metric_label,))
+        CATCHUP_SECONDS.observe(elapsed)
+        
+        logger.info(
+            f"Catch-up for {self.user_id}: {total} missed messages in {len(pending)} chats "
+            f"({elapsed:.1f}s, budget left {budget['remaining']})"
+        )
+        if total:
+            socket_emitter.emit('log_update', {
+                "message": f"⏪ تمت مراجعة {total} رسالة فائتة أثناء الانقطاع في {len(pending)} محادثة"
+            }, to=self.user_id)
+    
+    async def _catch_up_chat(self, dialog, last_id, cutoff, budget, semaphore):
+        """استدراك محادثة واحدة: الأحدث أولاً حتى الحد ثم المعالجة بالترتيب الزمني"""
+        async with semaphore:
+            limit = min(CATCHUP_MAX_PER_CHAT, budget['remaining'])
+            if limit <= 0:
+                return 0
+            # حجز الحصة قبل أول await حتى لا تتجاوز المحادثات المتوازية الميزانية
+            budget['remaining'] -= limit
+            
+            missed = []
+            try:
+                async for message in self.client.iter_messages(dialog.input_entity, limit=limit, min_id=last_id):
+                    if message.date is not None and message.date.timestamp() < cutoff:
+                        break
+                    missed.append(message)
+            except FloodWaitError as e:
+                logger.warning(f"Catch-up for {self.user_id} in chat {dialog.id} stopped by FloodWait ({e.seconds}s)")
+            except Exception as e:
+                logger.warning(f"Catch-up for {self.user_id} in chat {dialog.id} failed: {str(e)}")
+            finally:
+                budget['remaining'] += limit - len(missed)
+            
+            for message in reversed(missed):
+                await self._handle_new_message(BackfillEvent(message))
+            return len(missed)
     
     async def _register_event_handlers(self):
         """تسجيل event handlers للرسائل الجديدة"""
@@ -296,9 +2570,15 @@ class TelegramClientManager:
             if self.event_handlers_registered or not self.client:
                 return
             
-            @self.client.on(events.NewMessage)
-            async def new_message_handler(event):
-                await self._handle_new_message(event)
+            if capture_recorder.enabled:
+                @self.client.on(events.NewMessage)
+                async def new_message_handler(event):
+                    capture_recorder.record(self.user_id, event)
+                    await self._handle_new_message(event)
+            else:
+                @self.client.on(events.NewMessage)
+                async def new_message_handler(event):
+                    await self._handle_new_message(event)
             
             self.event_handlers_registered = True
             logger.info(f"Event handlers registered for user {self.user_id}")
@@ -309,56 +2589,171 @@ class TelegramClientManager:
     async def _handle_new_message(self, event):
         """معالجة الرسائل الجديدة الواردة - مراقبة شاملة لكامل الحساب"""
         try:
+            # قواعد المحادثات ونوع الرسالة قبل أي await
+            if self.message_filter is not None and not self.message_filter.accepts(event):
+                return
+            
             message = event.message
+            self.checkpoints.advance(event.chat_id, message.id)
+            if self.checkpoints.dirty:
+                self._schedule_checkpoint_flush()
             if not message.text:
                 return
-            
-            # الحصول على معلومات المحادثة
-            chat = await event.get_chat()
-            chat_username = getattr(chat, 'username', None)
-            chat_title = getattr(chat, 'title', None)
-            
-            # تحديد معرف المجموعة/المحادثة
-            group_identifier = None
-            if chat_username:
-                group_identifier = f"@{chat_username}"
-            elif chat_title:
-                group_identifier = chat_title
-            elif hasattr(chat, 'first_name'):
-                # محادثة شخصية
-                group_identifier = f"محادثة مع {chat.first_name}"
-            else:
-                group_identifier = f"محادثة {chat.id}"
+            MESSAGES_TOTAL.inc(labels=(self.metric_label,))
             
             # ⚠️ إزالة فحص المجموعات المحددة - مراقبة شاملة لكل شيء
             # مراقبة كامل المجموعات والمحادثات بدون استثناء
             
-            # فحص الكلمات المفتاحية في كل رسالة
+            # فحص الكلمات المفتاحية أولاً - لا حاجة لحل المحادثة إذا لم تطابق الرسالة
+            started = time.perf_counter()
             if self.monitored_keywords:  # إذا كان هناك كلمات مراقبة
-                message_lower = message.text.lower()
-                for keyword in self.monitored_keywords:
-                    keyword_lower = keyword.lower().strip()
-                    if keyword_lower and keyword_lower in message_lower:
-                        await self._trigger_keyword_alert(message, keyword, group_identifier, event)
+                matched_keywords = self.keyword_matcher.find_all(message.text)
+                if not matched_keywords:
+                    MESSAGE_STAGE_SECONDS.observe(time.perf_counter() - started, ('match',))
+                    return
             else:
                 # إذا لم تكن هناك كلمات محددة، راقب كل الرسائل
-                await self._trigger_keyword_alert(message, "رسالة جديدة", group_identifier, event)
+                matched_keywords = ["رسالة جديدة"]
+            matched = time.perf_counter()
+            MESSAGE_STAGE_SECONDS.observe(matched - started, ('match',))
+            
+            # الحصول على معلومات المحادثة والمرسل (من الذاكرة المؤقتة إن وجدت)
+            group_identifier = await self._resolve_chat_identifier(event)
+            sender_name = await self._resolve_sender_name(event)
+            resolved = time.perf_counter()
+            MESSAGE_STAGE_SECONDS.observe(resolved - matched, ('resolve',))
+            
+            backfilled = isinstance(event, BackfillEvent)
+            for keyword in matched_keywords:
+                await self._trigger_keyword_alert(message, keyword, group_identifier, sender_name, backfilled)
+            MESSAGE_STAGE_SECONDS.observe(time.perf_counter() - resolved, ('enqueue',))
+            ALERTS_TOTAL.inc(len(matched_keywords), (self.metric_label,))
         
         except Exception as e:
             logger.error(f"Error handling new message: {str(e)}")
     
-    async def _trigger_keyword_alert(self, message, keyword, group_identifier, event):
-        """تشغيل تنبيه الكلمة المفتاحية"""
+    async def _resolve_chat_identifier(self, event):
+        """تحديد معرف المجموعة/المحادثة مع ذاكرة مؤقتة حسب معرف المحادثة"""
+        chat_id = event.chat_id
+        group_identifier = self.chat_cache.get(chat_id) if chat_id is not None else None
+        if group_identifier is not None:
+            return group_identifier
+        
+        chat = await event.get_chat()
+        chat_username = getattr(chat, 'username', None)
+        chat_title = getattr(chat, 'title', None)
+        
+        if chat_username:
+            group_identifier = f"@{chat_username}"
+        elif chat_title:
+            group_identifier = chat_title
+        elif hasattr(chat, 'first_name'):
+            # محادثة شخصية
+            group_identifier = f"محادثة مع {chat.first_name}"
+        else:
+            group_identifier = f"محادثة {chat.id}"
+        
+        if chat_id is not None:
+            self.chat_cache.set(chat_id, group_identifier)
+        return group_identifier
+    
+    async def _resolve_sender_name(self, event):
+        """الحصول على اسم المرسل مع ذاكرة مؤقتة حسب معرف المرسل"""
+        sender_id = event.sender_id
+        sender_name = self.sender_cache.get(sender_id) if sender_id is not None else None
+        if sender_name is not None:
+            return sender_name
+        
+        try:
+            sender = await event.get_sender()
+        except Exception:
+            return "غير معروف"
+        
+        if not sender:
+            return "غير معروف"
+        
+        sender_name = getattr(sender, 'first_name', '') or getattr(sender, 'username', '') or str(sender.id)
+        if sender_id is not None:
+            self.sender_cache.set(sender_id, sender_name)
+        return sender_name
+    
+    def _load_peer_cache(self):
+        """تحميل الكيانات المحلولة المحفوظة"""
+        try:
+            if os.path.exists(self.peers_file):
+                with open(self.peers_file, "r", encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading peer cache for {self.user_id}: {str(e)}")
+        return {}
+    
+    def _save_peer_cache(self, snapshot):
+        """حفظ لقطة الكيانات المحلولة - كتابة ذرية (ملف مؤقت ثم إعادة تسمية)"""
+        try:
+            tmp_path = f"{self.peers_file}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.peers_file)
+        except Exception as e:
+            logger.error(f"Error saving peer cache for {self.user_id}: {str(e)}")
+    
+    async def resolve_peer(self, entity, refresh=False):
+        """حل معرف المجموعة إلى InputPeer مع ذاكرة دائمة"""
+        if not refresh and entity in self.peer_cache:
+            peer = deserialize_input_peer(self.peer_cache[entity])
+            if peer is not None:
+                return peer
+        
         try:
-            # الحصول على معلومات المرسل
-            sender_name = "غير معروف"
+            peer = await self.client.get_input_entity(entity)
+        except (ValueError, TypeError):
+            if entity.startswith('@') or entity.startswith('https://'):
+                raise
+            peer = await self.client.get_input_entity('@' + entity)
+        
+        data = serialize_input_peer(peer)
+        if data is not None:
+            self.peer_cache[entity] = data
+            # اللقطة تؤخذ على الـ loop حتى لا يتغير القاموس أثناء الكتابة في الـ executor
+            await asyncio.get_running_loop().run_in_executor(None, self._save_peer_cache, dict(self.peer_cache))
+        return peer
+    
+    async def _prefetch_peers(self, groups):
+        """حل كل المجموعات غير المحلولة مسبقاً"""
+        for group in groups:
+            if group in self.peer_cache:
+                continue
             try:
-                sender = await event.get_sender()
-                if sender:
-                    sender_name = getattr(sender, 'first_name', '') or getattr(sender, 'username', '') or str(sender.id)
-            except:
-                pass
-            
+                await self.resolve_peer(group)
+            except (AuthKeyUnregisteredError, UserDeactivatedError):
+                self.authorized = False
+                return
+            except Exception as e:
+                logger.warning(f"Could not pre-resolve {group} for {self.user_id}: {str(e)}")
+    
+    def prefetch_peers(self, groups):
+        """جدولة حل المجموعات في الخلفية دون انتظار"""
+        groups = [g.strip() for g in groups if g and g.strip()]
+        if groups and self.client and self.loop:
+            self.submit_coroutine(self._prefetch_peers(groups))
+    
+    async def send_to_peer(self, entity, message):
+        """إرسال رسالة عبر الكيان المحلول، مع تحديث الكيان مرة واحدة عند فشله"""
+        try:
+            peer = await self.resolve_peer(entity)
+            try:
+                return await self.client.send_message(peer, message)
+            except (ValueError, PeerIdInvalidError, ChannelInvalidError, ChatIdInvalidError):
+                # الكيان المحفوظ قديم - حله من جديد وأعد المحاولة
+                peer = await self.resolve_peer(entity, refresh=True)
+                return await self.client.send_message(peer, message)
+        except (AuthKeyUnregisteredError, UserDeactivatedError):
+            self.authorized = False
+            raise
+    
+    async def _trigger_keyword_alert(self, message, keyword, group_identifier, sender_name, backfilled=False):
+        """تشغيل تنبيه الكلمة المفتاحية"""
+        try:
             # إنشاء بيانات التنبيه
             alert_data = {
                 "keyword": keyword,
@@ -368,38 +2763,85 @@ class TelegramClientManager:
                 "sender": sender_name,
                 "message_time": time.strftime('%H:%M:%S', time.localtime(message.date.timestamp())),
                 "message_id": message.id,
-                "full_message": message.text
+                "message_ts": message.date.timestamp(),
+                "full_message": message.text,
+                "urgent": normalize_text(keyword) in self.urgent_keywords,
+                "dedup_key": None,
+                "seen_in": 1,
+                "backfilled": backfilled
             }
             
+            dedup_key = AlertDeduplicator.content_key(message.text, keyword) if self.alert_dedup.enabled else None
+            if dedup_key is not None:
+                alert_data['dedup_key'] = dedup_key
+                original, new_chat = self.alert_dedup.fold(dedup_key, message.chat_id, alert_data)
+                if original is not None:
+                    # نسخة من رسالة منشورة سابقاً - تُطوى في التنبيه الأصلي
+                    ALERTS_DEDUPLICATED.inc(labels=(self.metric_label,))
+                    if new_chat:
+                        # الأصل غالباً أُرسل وحُفظ - التحديث يمر بنفس القائمة حتى يُعالج بعده
+                        alert_queue.add_seen_in(self.user_id, original, group_identifier)
+                    return
+            
             # إضافة التنبيه للقائمة
             alert_queue.add_alert(self.user_id, alert_data)
             
-            logger.info(f"Keyword alert triggered for user {self.user_id}: '{keyword}' in {group_identifier}")
+            logger.info(
+                f"Keyword alert triggered for user {self.user_id}: '{keyword}' in {group_identifier}",
+                extra={'category': 'alert'}
+            )
             
         except Exception as e:
             logger.error(f"Error triggering keyword alert: {str(e)}")
     
-    def update_monitoring_settings(self, keywords, groups):
+    def update_monitoring_settings(self, keywords, groups, urgent_keywords=(), message_filter=None):
         """تحديث إعدادات المراقبة - فقط الكلمات المفتاحية (المجموعات للإرسال فقط)"""
+        self.message_filter = message_filter
         self.monitored_keywords = [k.strip() for k in keywords if k.strip()]
+        self.keyword_matcher = KeywordMatcher(self.monitored_keywords)
+        self.urgent_keywords = frozenset(normalize_text(k.strip()) for k in urgent_keywords if k.strip())
         # ⚠️ لا نحفظ مجموعات المراقبة - نراقب كل شيء
         # نحفظ مجموعات الإرسال منفصلة في الإعدادات العادية
         
         logger.info(f"Updated monitoring settings for {self.user_id}: {len(self.monitored_keywords)} keywords - مراقبة شاملة لكامل الحساب")
+        self.request_catch_up()
     
     def run_coroutine(self, coro):
         """تشغيل coroutine في event loop الخاص بالعميل"""
         if not self.loop:
             raise Exception("Event loop not initialized")
         
+        if threading.current_thread() in client_runtime.threads:
+            # الانتظار من داخل loop مشترك يجمّد كل عملاء هذا الـ loop
+            coro.close()
+            raise Exception("run_coroutine cannot block inside a client event loop")
+        
         future = asyncio.run_coroutine_threadsafe(coro, self.loop)
-        return future.result(timeout=30)
+        started = time.perf_counter()
+        try:
+            return future.result(timeout=30)
+        except concurrent.futures.TimeoutError:
+            RUN_COROUTINE_TIMEOUTS.inc()
+            raise
+        finally:
+            RUN_COROUTINE_SECONDS.observe(time.perf_counter() - started)
+    
+    def submit_coroutine(self, coro):
+        """جدولة coroutine في event loop الخاص بالعميل وإرجاع Future دون انتظار"""
+        if not self.loop or self.loop.is_closed():
+            raise Exception("Event loop not initialized")
+        
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
     
     def stop(self):
         """إيقاف العميل"""
-        self.stop_flag.set()
-        if self.thread:
-            self.thread.join(timeout=5)
+        if self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        if self.task:
+            try:
+                self.task.result(timeout=5)
+            except Exception:
+                pass
 
 # =========================== 
 # مدير التليجرام الرئيسي
@@ -420,7 +2862,7 @@ class TelegramManager:
         """إعداد عميل التليجرام"""
         try:
             if not API_ID or not API_HASH:
-                socketio.emit('log_update', {
+                socket_emitter.emit('log_update', {
                     "message": "❌ لم يتم إعداد بيانات Telegram API"
                 }, to=user_id)
                 return {
@@ -428,23 +2870,22 @@ class TelegramManager:
                     "message": "❌ بيانات API غير متوفرة - يرجى إضافة TELEGRAM_API_ID و TELEGRAM_API_HASH في الأسرار"
                 }
             
-            socketio.emit('log_update', {
+            socket_emitter.emit('log_update', {
                 "message": "🔄 جاري إعداد العميل..."
             }, to=user_id)
             
             client_manager = self.get_client_manager(user_id)
             client_manager.start_client_thread()
             
-            socketio.emit('log_update', {
+            socket_emitter.emit('log_update', {
                 "message": "📡 فحص حالة التصريح..."
             }, to=user_id)
             
-            is_authorized = client_manager.run_coroutine(
-                client_manager.client.is_user_authorized()
-            )
+            # حالة التصريح تُقرأ مرة واحدة عند الاتصال وتُحدّث من أحداث العميل
+            is_authorized = client_manager.authorized
             
             if not is_authorized:
-                socketio.emit('log_update', {
+                socket_emitter.emit('log_update', {
                     "message": f"📱 إرسال كود التحقق إلى: {phone_number}"
                 }, to=user_id)
                 
@@ -452,15 +2893,17 @@ class TelegramManager:
                     client_manager.client.send_code_request(phone_number)
                 )
                 
-                with USERS_LOCK:
-                    if user_id in USERS:
-                        USERS[user_id]['awaiting_code'] = True
-                        USERS[user_id]['phone_code_hash'] = sent.phone_code_hash
-                        USERS[user_id]['client_manager'] = client_manager
-                        USERS[user_id]['connected'] = True
+                user = USERS.get(user_id)
+                if user:
+                    user.update(
+                        awaiting_code=True,
+                        phone_code_hash=sent.phone_code_hash,
+                        client_manager=client_manager,
+                        connected=True
+                    )
                 
                 # إرسال إشعار تحديث حالة تسجيل الدخول
-                socketio.emit('login_status', {
+                socket_emitter.emit('login_status', {
                     "logged_in": False,
                     "connected": True,
                     "awaiting_code": True,
@@ -468,7 +2911,7 @@ class TelegramManager:
                     "is_running": False
                 }, to=user_id)
                 
-                socketio.emit('log_update', {
+                socket_emitter.emit('log_update', {
                     "message": "✅ تم إرسال كود التحقق - تحقق من رسائل تيليجرام"
                 }, to=user_id)
                 
@@ -477,16 +2920,18 @@ class TelegramManager:
                     "message": "📱 تم إرسال كود التحقق"
                 }
             else:
-                with USERS_LOCK:
-                    if user_id in USERS:
-                        USERS[user_id]['client_manager'] = client_manager
-                        USERS[user_id]['connected'] = True
-                        USERS[user_id]['authenticated'] = True
-                        USERS[user_id]['awaiting_code'] = False
-                        USERS[user_id]['awaiting_password'] = False
+                user = USERS.get(user_id)
+                if user:
+                    user.update(
+                        client_manager=client_manager,
+                        connected=True,
+                        authenticated=True,
+                        awaiting_code=False,
+                        awaiting_password=False
+                    )
                 
                 # إرسال إشعار نجح تسجيل الدخول
-                socketio.emit('login_status', {
+                socket_emitter.emit('login_status', {
                     "logged_in": True,
                     "connected": True,
                     "awaiting_code": False,
@@ -494,7 +2939,7 @@ class TelegramManager:
                     "is_running": False
                 }, to=user_id)
                 
-                socketio.emit('connection_status', {
+                socket_emitter.emit('connection_status', {
                     "status": "connected"
                 }, to=user_id)
                 
@@ -502,7 +2947,7 @@ class TelegramManager:
         
         except Exception as e:
             logger.error(f"Setup error for {user_id}: {str(e)}")
-            socketio.emit('log_update', {
+            socket_emitter.emit('log_update', {
                 "message": f"❌ خطأ في الإعداد: {str(e)}"
             }, to=user_id)
             return {"status": "error", "message": f"❌ خطأ: {str(e)}"}
@@ -510,13 +2955,14 @@ class TelegramManager:
     def verify_code(self, user_id, code):
         """التحقق من كود التحقق"""
         try:
-            with USERS_LOCK:
-                if user_id not in USERS or not USERS[user_id].get('awaiting_code'):
-                    return {"status": "error", "message": "❌ لم يتم طلب كود التحقق"}
-                
-                client_manager = USERS[user_id].get('client_manager')
-                phone_code_hash = USERS[user_id].get('phone_code_hash')
-                phone = USERS[user_id]['settings']['phone']
+            state = USERS.get(user_id)
+            if not state or not state.awaiting_code:
+                return {"status": "error", "message": "❌ لم يتم طلب كود التحقق"}
+            
+            with state.lock:
+                client_manager = state.client_manager
+                phone_code_hash = state.phone_code_hash
+                phone = state.settings['phone']
             
             if not client_manager or not phone_code_hash:
                 return {"status": "error", "message": "❌ بيانات الجلسة مفقودة"}
@@ -525,15 +2971,17 @@ class TelegramManager:
                 user = client_manager.run_coroutine(
                     client_manager.client.sign_in(phone, code, phone_code_hash=phone_code_hash)
                 )
+                client_manager.authorized = True
                 
-                with USERS_LOCK:
-                    USERS[user_id]['connected'] = True
-                    USERS[user_id]['authenticated'] = True
-                    USERS[user_id]['awaiting_code'] = False
-                    USERS[user_id]['awaiting_password'] = False
+                state.update(
+                    connected=True,
+                    authenticated=True,
+                    awaiting_code=False,
+                    awaiting_password=False
+                )
                 
                 # إرسال تحديث حالة تسجيل الدخول
-                socketio.emit('login_status', {
+                socket_emitter.emit('login_status', {
                     "logged_in": True,
                     "connected": True,
                     "awaiting_code": False,
@@ -541,19 +2989,17 @@ class TelegramManager:
                     "is_running": False
                 }, to=user_id)
                 
-                socketio.emit('connection_status', {
+                socket_emitter.emit('connection_status', {
                     "status": "connected"
                 }, to=user_id)
                 
                 return {"status": "success", "message": "✅ تم التحقق بنجاح"}
             
             except SessionPasswordNeededError:
-                with USERS_LOCK:
-                    USERS[user_id]['awaiting_code'] = False
-                    USERS[user_id]['awaiting_password'] = True
+                state.update(awaiting_code=False, awaiting_password=True)
                 
                 # إرسال تحديث حالة تسجيل الدخول
-                socketio.emit('login_status', {
+                socket_emitter.emit('login_status', {
                     "logged_in": False,
                     "connected": True,
                     "awaiting_code": False,
@@ -577,11 +3023,11 @@ class TelegramManager:
     def verify_password(self, user_id, password):
         """التحقق من كلمة المرور"""
         try:
-            with USERS_LOCK:
-                if user_id not in USERS or not USERS[user_id].get('awaiting_password'):
-                    return {"status": "error", "message": "❌ لم يتم طلب كلمة المرور"}
-                
-                client_manager = USERS[user_id].get('client_manager')
+            state = USERS.get(user_id)
+            if not state or not state.awaiting_password:
+                return {"status": "error", "message": "❌ لم يتم طلب كلمة المرور"}
+            
+            client_manager = state.client_manager
             
             if not client_manager:
                 return {"status": "error", "message": "❌ بيانات الجلسة مفقودة"}
@@ -590,11 +3036,9 @@ class TelegramManager:
                 await_result = client_manager.run_coroutine(
                     client_manager.client.sign_in(password=password)
                 )
+                client_manager.authorized = True
                 
-                with USERS_LOCK:
-                    USERS[user_id]['connected'] = True
-                    USERS[user_id]['authenticated'] = True
-                    USERS[user_id]['awaiting_password'] = False
+                state.update(connected=True, authenticated=True, awaiting_password=False)
                 
                 return {"status": "success", "message": "✅ تم التحقق بنجاح"}
             
@@ -608,35 +3052,21 @@ class TelegramManager:
     def send_message_async(self, user_id, entity, message):
         """إرسال رسالة"""
         try:
-            with USERS_LOCK:
-                if user_id not in USERS:
-                    raise Exception("المستخدم غير موجود")
-                
-                client_manager = USERS[user_id].get('client_manager')
+            user = USERS.get(user_id)
+            if not user:
+                raise Exception("المستخدم غير موجود")
+            
+            client_manager = user.client_manager
             
             if not client_manager:
                 raise Exception("العميل غير متصل")
             
-            is_authorized = client_manager.run_coroutine(
-                client_manager.client.is_user_authorized()
-            )
-            
-            if not is_authorized:
+            if client_manager.authorized is False:
                 raise Exception("العميل غير مصرح")
             
-            try:
-                entity_obj = client_manager.run_coroutine(
-                    client_manager.client.get_entity(entity)
-                )
-            except:
-                if not entity.startswith('@') and not entity.startswith('https://'):
-                    entity = '@' + entity
-                entity_obj = client_manager.run_coroutine(
-                    client_manager.client.get_entity(entity)
-                )
-            
+            # رحلة واحدة إلى loop العميل: الحل من الذاكرة ثم الإرسال
             result = client_manager.run_coroutine(
-                client_manager.client.send_message(entity_obj, message)
+                client_manager.send_to_peer(entity, message)
             )
             
             return {"success": True, "message_id": result.id}
@@ -651,19 +3081,202 @@ telegram_manager = TelegramManager()
 # =========================== 
 # نظام المراقبة المحسن مع Event Handlers
 # ===========================
+class MonitoringScheduler:
+    """مُجدول واحد لكل المستخدمين - heap بمواعيد الاستحقاق بدل thread استطلاع لكل مستخدم"""
+    
+    MAX_CONSECUTIVE_ERRORS = 5
+    
+    def __init__(self, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.heartbeat_interval = heartbeat_interval
+        self.heap = []
+        self.cond = threading.Condition()
+        self.generations = {}
+        self.pending_sends = set()
+        self.active_sends = {}
+        self.consecutive_errors = {}
+        self.seq = 0
+        self.thread = None
+    
+    def start(self):
+        """بدء thread المُجدول"""
+        with self.cond:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name="monitoring-scheduler", daemon=True)
+            self.thread.start()
+        logger.info("Monitoring scheduler started")
+    
+    def _push(self, due, user_id, kind):
+        """إضافة مهمة للـ heap (يجب حجز self.cond)"""
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, user_id, kind, self.generations.get(user_id, 0)))
+        if kind == 'send':
+            self.pending_sends.add(user_id)
+        self.cond.notify()
+    
+    def register(self, user_id, settings, last_scheduled_send=0):
+        """تسجيل مستخدم: إشارة حياة فورية وأول موعد للإرسال المجدول"""
+        self.start()
+        now = time.time()
+        with self.cond:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            self.pending_sends.discard(user_id)
+            self.consecutive_errors[user_id] = 0
+            self._push(now, user_id, 'heartbeat')
+            if settings.get('send_type', 'manual') == 'scheduled':
+                interval_seconds = int(settings.get('interval_seconds', 3600))
+                self._push(max(now, last_scheduled_send + interval_seconds), user_id, 'send')
+    
+    def unregister(self, user_id):
+        """إلغاء كل المهام المعلقة للمستخدم"""
+        with self.cond:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            self.pending_sends.discard(user_id)
+            self.cond.notify()
+    
+    def _run(self):
+        """النوم حتى أقرب موعد ثم تنفيذ المهمة"""
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    timeout = self.heap[0][0] - time.time() if self.heap else None
+                    self.cond.wait(timeout)
+                
+                due, _, user_id, kind, generation = heapq.heappop(self.heap)
+                if generation != self.generations.get(user_id, 0):
+                    continue
+                if kind == 'send':
+                    self.pending_sends.discard(user_id)
+            
+            try:
+                if kind == 'heartbeat':
+                    self._dispatch_heartbeat(user_id)
+                else:
+                    self._dispatch_send(user_id)
+            except Exception as e:
+                logger.error(f"Scheduler dispatch error for {user_id}: {str(e)}")
+    
+    def _snapshot(self, user_id):
+        """قراءة سريعة لحالة المستخدم - اللقطات تُقرأ بدون قفل"""
+        user = USERS.get(user_id)
+        if not user or not user.is_running:
+            return None
+        user.monitoring_active = True
+        return user.settings, user.last_scheduled_send, user.client_manager
+    
+    def _dispatch_heartbeat(self, user_id):
+        """إرسال إشارة حياة وإعادة جدولتها"""
+        snapshot = self._snapshot(user_id)
+        if snapshot is None:
+            self.unregister(user_id)
+            finish_monitoring(user_id)
+            return
+        
+        settings, last_scheduled_send, _ = snapshot
+        if socket_emitter.has_listeners(user_id):
+            socket_emitter.emit('heartbeat', {
+                'timestamp': time.strftime('%H:%M:%S'),
+                'status': 'active',
+                'type': 'event_driven_monitoring',
+                'keywords_active': bool(settings.get('watch_words', [])),
+                'event_handlers': True
+            }, to=user_id)
+        
+        with self.cond:
+            self._push(time.time() + self.heartbeat_interval, user_id, 'heartbeat')
+            # التقاط تغيير نوع الإرسال إلى مجدول أثناء التشغيل
+            if (settings.get('send_type', 'manual') == 'scheduled'
+                    and user_id not in self.pending_sends and user_id not in self.active_sends):
+                interval_seconds = int(settings.get('interval_seconds', 3600))
+                self._push(max(time.time(), last_scheduled_send + interval_seconds), user_id, 'send')
+    
+    def _dispatch_send(self, user_id):
+        """تنفيذ الإرسال المجدول كـ coroutine على loop العميل"""
+        snapshot = self._snapshot(user_id)
+        if snapshot is None:
+            return
+        
+        settings, _, client_manager = snapshot
+        if settings.get('send_type', 'manual') != 'scheduled':
+            return
+        
+        started_at = time.time()
+        user = USERS.get(user_id)
+        if user:
+            user.last_scheduled_send = started_at
+        
+        logger.info(f"Executing scheduled send for user {user_id}", extra={'category': 'scheduled_send'})
+        if not client_manager:
+            future = concurrent.futures.Future()
+            future.set_exception(Exception("العميل غير متصل"))
+        else:
+            # مهلة التشغيل = الفترة بين دورتين حتى لا تتداخل الدورات
+            deadline = started_at + int(settings.get('interval_seconds', 3600))
+            future = client_manager.submit_coroutine(
+                execute_scheduled_messages_async(user_id, settings, client_manager, deadline)
+            )
+        generation = self.generations.get(user_id, 0)
+        with self.cond:
+            self.active_sends[user_id] = future
+        future.add_done_callback(lambda f: self._on_send_done(user_id, generation, started_at, f))
+    
+    def _on_send_done(self, user_id, generation, started_at, future):
+        """تسجيل نتيجة الإرسال وجدولة الموعد التالي"""
+        error = None if future.cancelled() else future.exception()
+        
+        user = USERS.get(user_id)
+        settings = user.settings if user else {}
+        interval_seconds = int(settings.get('interval_seconds', 3600))
+        
+        with self.cond:
+            self.active_sends.pop(user_id, None)
+            if error is None:
+                self.consecutive_errors[user_id] = 0
+            else:
+                self.consecutive_errors[user_id] = self.consecutive_errors.get(user_id, 0) + 1
+            errors = self.consecutive_errors[user_id]
+            
+            if generation == self.generations.get(user_id, 0) and errors < self.MAX_CONSECUTIVE_ERRORS:
+                self._push(started_at + interval_seconds, user_id, 'send')
+        
+        if error is None:
+            return
+        
+        logger.error(f"Monitoring cycle error for {user_id}: {str(error)}")
+        socket_emitter.emit('log_update', {
+            "message": f"⚠️ خطأ في المراقبة: {str(error)[:100]}"
+        }, to=user_id)
+        
+        if errors >= self.MAX_CONSECUTIVE_ERRORS:
+            socket_emitter.emit('log_update', {
+                "message": f"❌ تم إيقاف المراقبة بسبب تكرار الأخطاء ({errors})"
+            }, to=user_id)
+            user = USERS.get(user_id)
+            if user:
+                user.is_running = False
+            self.unregister(user_id)
+            finish_monitoring(user_id)
+
+# إنشاء المُجدول العالمي
+monitoring_scheduler = MonitoringScheduler()
+
 def monitoring_worker(user_id):
-    """مهمة المراقبة المحسنة مع Event Handlers"""
+    """بدء المراقبة المحسنة مع Event Handlers - التسجيل في المُجدول المشترك بدل حلقة استطلاع"""
     logger.info(f"Starting enhanced monitoring worker with event handlers for user {user_id}")
     
     try:
-        with USERS_LOCK:
-            if user_id in USERS:
-                USERS[user_id]['monitoring_active'] = True
-                client_manager = USERS[user_id].get('client_manager')
-                settings = USERS[user_id]['settings']
+        user = USERS.get(user_id)
+        client_manager = None
+        if user:
+            with user.lock:
+                user.monitoring_active = True
+                client_manager = user.client_manager
+                settings = user.settings
+                last_scheduled_send = user.last_scheduled_send
         
         if not client_manager:
             logger.error(f"No client manager for user {user_id}")
+            finish_monitoring(user_id)
             return
         
         # تحديث إعدادات المراقبة في العميل
@@ -671,181 +3284,399 @@ def monitoring_worker(user_id):
         send_groups = settings.get('groups', [])  # مجموعات الإرسال فقط
         
         if hasattr(client_manager, 'update_monitoring_settings'):
-            client_manager.update_monitoring_settings(watch_words, send_groups)
+            client_manager.update_monitoring_settings(
+                watch_words, send_groups, settings.get('urgent_words', []), MessageFilter.from_settings(settings)
+            )
+        
+        # ضبط وضع ملخصات الرسائل المحفوظة
+        alert_queue.configure_user(
+            user_id,
+            digest_interval=settings.get('digest_interval', ALERT_DIGEST_INTERVAL),
+            digest_max_alerts=settings.get('digest_max_alerts', ALERT_DIGEST_MAX_ALERTS)
+        )
         
         # إرسال إشعار بدء المراقبة
         if watch_words:
-            socketio.emit('log_update', {
+            socket_emitter.emit('log_update', {
                 "message": f"🚀 بدأت المراقبة الشاملة الفورية - {len(watch_words)} كلمة مراقبة في كامل الحساب | الإرسال لـ {len(send_groups)} مجموعة"
             }, to=user_id)
         else:
-            socketio.emit('log_update', {
+            socket_emitter.emit('log_update', {
                 "message": f"🚀 بدأت المراقبة الشاملة لكامل الرسائل في الحساب | الإرسال لـ {len(send_groups)} مجموعة"
             }, to=user_id)
         
-        # الحفاظ على المراقبة نشطة
-        consecutive_errors = 0
-        max_consecutive_errors = 5
+        # إشارات الحياة والإرسال المجدول يتولاها المُجدول المشترك
+        monitoring_scheduler.register(user_id, settings, last_scheduled_send)
+        remember_monitoring_state(user_id, True)
+    
+    except Exception as e:
+        logger.error(f"Monitoring worker error for {user_id}: {str(e)}")
+        finish_monitoring(user_id)
+
+def remember_monitoring_state(user_id, enabled):
+    """حفظ حالة المراقبة في الإعدادات لاستئنافها بعد إعادة التشغيل"""
+    user = USERS.get(user_id)
+    if not user or user.settings.get('monitoring_enabled') == enabled:
+        return
+    
+    save_settings(user_id, user.update_settings(monitoring_enabled=enabled))
+
+def finish_monitoring(user_id):
+    """تنظيف حالة المراقبة بعد الإيقاف"""
+    user = USERS.get(user_id)
+    if user:
+        user.update(is_running=False, monitoring_active=False, thread=None)
+    
+    remember_monitoring_state(user_id, False)
+    
+    socket_emitter.emit('log_update', {
+        "message": "⏹ تم إيقاف نظام المراقبة المحسن"
+    }, to=user_id)
+    
+    socket_emitter.emit('heartbeat', {
+        'timestamp': time.strftime('%H:%M:%S'),
+        'status': 'stopped'
+    }, to=user_id)
+    
+    logger.info(f"Enhanced monitoring worker ended for user {user_id}")
+
+class SessionReconnector:
+    """إعادة اتصال الحسابات المصرح بها في الخلفية بتوازي محدود وتراجع أسي"""
+    
+    def __init__(self, concurrency=RECONNECT_CONCURRENCY, max_attempts=RECONNECT_MAX_ATTEMPTS, backoff=RECONNECT_BACKOFF):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lock = Lock()
+        self.thread = None
+        self.progress = {'total': 0, 'done': 0, 'connected': 0, 'unauthorized': 0, 'failed': 0, 'resumed': 0}
+    
+    def start(self, user_ids):
+        """بدء إعادة الاتصال لكل حساب له ملف جلسة"""
+        user_ids = [
+            user_id for user_id in user_ids
+            if os.path.exists(os.path.join(SESSIONS_DIR, f"{user_id}_session.session"))
+        ]
+        if not user_ids or not API_ID or not API_HASH:
+            return
+        
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.progress = {'total': len(user_ids), 'done': 0, 'connected': 0, 'unauthorized': 0, 'failed': 0, 'resumed': 0}
+            self.thread = threading.Thread(target=self._run, args=(user_ids,), name="session-reconnector", daemon=True)
+            self.thread.start()
+    
+    def status(self):
+        """تقدم إعادة الاتصال"""
+        with self.lock:
+            return dict(self.progress)
+    
+    def _run(self, user_ids):
+        started_at = time.time()
+        logger.info(f"Reconnecting {len(user_ids)} sessions (concurrency {self.concurrency})")
         
-        while True:
-            with USERS_LOCK:
-                if user_id not in USERS or not USERS[user_id]['is_running']:
-                    logger.info(f"Stopping monitoring for user {user_id}")
-                    break
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="reconnect") as executor:
+            for user_id, result in zip(user_ids, executor.map(self._reconnect_user, user_ids)):
+                with self.lock:
+                    self.progress['done'] += 1
+                    self.progress[result] += 1
+                    progress = dict(self.progress)
                 
-                user_data = USERS[user_id].copy()
-                USERS[user_id]['monitoring_active'] = True
-            
+                if progress['done'] % 25 == 0 or progress['done'] == progress['total']:
+                    logger.info(f"Reconnect progress: {progress}")
+        
+        logger.info(f"Reconnect finished in {time.time() - started_at:.1f}s: {self.status()}")
+    
+    def _reconnect_user(self, user_id):
+        """إعادة اتصال حساب واحد مع إعادة المحاولة"""
+        for attempt in range(self.max_attempts):
             try:
-                # تنفيذ الإرسال المجدول إذا كان مطلوب
-                settings = user_data['settings']
-                send_type = settings.get('send_type', 'manual')
-                current_time = time.time()
-                
-                if send_type == 'scheduled':
-                    interval_seconds = int(settings.get('interval_seconds', 3600))
-                    last_send = user_data.get('last_scheduled_send', 0)
-                    
-                    if current_time - last_send >= interval_seconds:
-                        logger.info(f"Executing scheduled send for user {user_id}")
-                        execute_scheduled_messages(user_id, settings)
-                        
-                        with USERS_LOCK:
-                            if user_id in USERS:
-                                USERS[user_id]['last_scheduled_send'] = current_time
+                client_manager = telegram_manager.get_client_manager(user_id)
+                client_manager.start_client_thread()
                 
-                consecutive_errors = 0
+                if not client_manager.authorized:
+                    client_manager.stop()
+                    return 'unauthorized'
                 
-                # إرسال إشارة حياة
-                status_info = {
-                    'timestamp': time.strftime('%H:%M:%S'),
-                    'status': 'active',
-                    'type': 'event_driven_monitoring',
-                    'keywords_active': bool(watch_words),
-                    'event_handlers': True
-                }
+                user = USERS.get(user_id)
+                if not user:
+                    client_manager.stop()
+                    return 'failed'
                 
-                socketio.emit('heartbeat', status_info, to=user_id)
-            
-            except Exception as e:
-                consecutive_errors += 1
-                logger.error(f"Monitoring cycle error for {user_id}: {str(e)}")
+                with user.lock:
+                    user.client_manager = client_manager
+                    user.connected = True
+                    user.authenticated = True
+                    settings = user.settings
+                    resume = settings.get('monitoring_enabled', False) and not user.is_running
+                    if resume:
+                        user.is_running = True
                 
-                socketio.emit('log_update', {
-                    "message": f"⚠️ خطأ في المراقبة: {str(e)[:100]}"
+                client_manager.update_monitoring_settings(
+                    settings.get('watch_words', []), settings.get('groups', []), settings.get('urgent_words', []),
+                    MessageFilter.from_settings(settings)
+                )
+                socket_emitter.emit('log_update', {
+                    "message": "🔄 تمت إعادة الاتصال تلقائياً بعد إعادة تشغيل الخادم"
                 }, to=user_id)
                 
-                if consecutive_errors >= max_consecutive_errors:
-                    socketio.emit('log_update', {
-                        "message": f"❌ تم إيقاف المراقبة بسبب تكرار الأخطاء ({consecutive_errors})"
-                    }, to=user_id)
-                    break
+                if resume:
+                    monitoring_worker(user_id)
+                    with self.lock:
+                        self.progress['resumed'] += 1
+                return 'connected'
             
-            # فترة انتظار مناسبة
-            time.sleep(10)
-    
-    except Exception as e:
-        logger.error(f"Monitoring worker error for {user_id}: {str(e)}")
-    finally:
-        with USERS_LOCK:
-            if user_id in USERS:
-                USERS[user_id]['is_running'] = False
-                USERS[user_id]['monitoring_active'] = False
-                USERS[user_id]['thread'] = None
-        
-        socketio.emit('log_update', {
-            "message": "⏹ تم إيقاف نظام المراقبة المحسن"
-        }, to=user_id)
+            except Exception as e:
+                delay = min(60.0, self.backoff * (2 ** attempt))
+                logger.warning(f"Reconnect attempt {attempt + 1} failed for {user_id}: {str(e)} - retry in {delay:.0f}s")
+                time.sleep(delay)
         
-        socketio.emit('heartbeat', {
-            'timestamp': time.strftime('%H:%M:%S'),
-            'status': 'stopped'
-        }, to=user_id)
+        return 'failed'
+
+# إنشاء معيد الاتصال العالمي
+session_reconnector = SessionReconnector()
+
+def _user_stats_metric(field):
+    return {
+        (metric_user_label(user_id),): state.stats[field]
+        for user_id, state in list(USERS.items())
+    }
+
+def _entity_cache_metric(field):
+    """مجموع إحصائيات ذاكرة الكيانات (المحادثات والمرسلين) لكل العملاء"""
+    totals = {('chat',): 0, ('sender',): 0}
+    for client_manager in list(telegram_manager.client_managers.values()):
+        totals[('chat',)] += client_manager.chat_cache.stats()[field]
+        totals[('sender',)] += client_manager.sender_cache.stats()[field]
+    return totals
+
+# مقاييس تُقرأ من الحالة الحالية عند كل طلب /metrics
+metrics.gauge('alert_queue_depth', 'Alerts waiting in AlertQueue', callback=lambda: alert_queue.queue.qsize())
+metrics.gauge('alert_queue_dropped_total', 'Alerts dropped by overflow or burst limit',
+              callback=lambda: alert_queue.dropped, kind='counter')
+metrics.gauge('alert_queue_coalesced_total', 'Alerts merged into an existing alert',
+              callback=lambda: alert_queue.coalesced, kind='counter')
+metrics.gauge('socketio_suppressed_total', 'Socket.IO emits skipped for rooms without listeners',
+              callback=lambda: socket_emitter.suppressed, kind='counter')
+metrics.gauge('telegram_sent_total', 'Successful scheduled sends per user (stats.sent)', ('user',),
+              callback=lambda: _user_stats_metric('sent'), kind='counter')
+metrics.gauge('telegram_send_errors_total', 'Failed sends per user (stats.errors)', ('user',),
+              callback=lambda: _user_stats_metric('errors'), kind='counter')
+metrics.gauge('telegram_users', 'Loaded user sessions', callback=lambda: len(USERS))
+metrics.gauge('client_runtime_loops', 'Shared asyncio loops started',
+              callback=lambda: client_runtime.stats()['loops'])
+metrics.gauge('client_runtime_threads_alive', 'Shared client loop threads alive',
+              callback=lambda: client_runtime.stats()['threads_alive'])
+metrics.gauge('process_threads', 'Python threads in the process', callback=threading.active_count)
+metrics.gauge('entity_cache_hits_total', 'EntityCache lookups served from memory', ('cache',),
+              callback=lambda: _entity_cache_metric('hits'), kind='counter')
+metrics.gauge('entity_cache_misses_total', 'EntityCache lookups that needed a Telegram call', ('cache',),
+              callback=lambda: _entity_cache_metric('misses'), kind='counter')
+metrics.gauge('entity_cache_evictions_total', 'EntityCache entries evicted by the size limit', ('cache',),
+              callback=lambda: _entity_cache_metric('evictions'), kind='counter')
+metrics.gauge('entity_cache_size', 'Entries currently held in EntityCache', ('cache',),
+              callback=lambda: _entity_cache_metric('size'))
+metrics.gauge('session_reconnect_progress', 'Background session reconnect progress by state', ('state',),
+              callback=lambda: {(state,): count for state, count in session_reconnector.status().items()})
+
+class ProgressReporter:
+    """تجميع أسطر تقدم الإرسال وإرسالها على دفعات بدل حدث لكل مجموعة"""
+    
+    def __init__(self, user_id, batch_size=PROGRESS_BATCH_SIZE, flush_interval=PROGRESS_FLUSH_INTERVAL):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lines = []
+        self.sent = 0
+        self.errors = 0
+        self.flushed_at = time.monotonic()
+    
+    def add(self, line, sent=0, errors=0):
+        self.lines.append(line)
+        self.sent += sent
+        self.errors += errors
+        if len(self.lines) >= self.batch_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+    
+    def flush(self):
+        """إرسال الأسطر المجمعة وتحديث الإحصائيات مرة واحدة"""
+        if self.sent or self.errors:
+            user = USERS.get(self.user_id)
+            if user:
+                user.add_stats(sent=self.sent, errors=self.errors)
+            self.sent = self.errors = 0
         
-        logger.info(f"Enhanced monitoring worker ended for user {user_id}")
+        if self.lines:
+            socket_emitter.emit('log_update', {
+                "message": "\n".join(self.lines)
+            }, to=self.user_id)
+            self.lines = []
+        self.flushed_at = time.monotonic()
 
-def execute_scheduled_messages(user_id, settings):
-    """تنفيذ الإرسال المجدول"""
-    groups = settings.get('groups', [])
+async def execute_scheduled_messages_async(user_id, settings, client_manager, deadline=None):
+    """تنفيذ الإرسال المجدول على loop العميل مع احترام FloodWait/SlowMode بإعادة الجدولة"""
+    groups = [g.strip() for g in settings.get('groups', []) if g and g.strip()]
     message = settings.get('message', '')
     
     if not groups or not message:
         return
     
+    total = len(groups)
+    progress = ProgressReporter(user_id)
+    progress.add(f"📅 تنفيذ الإرسال المجدول إلى {total} مجموعة")
+    
+    successful = 0
+    failed = 0
+    deferred = 0
+    loop = asyncio.get_running_loop()
+    
+    # (موعد الجاهزية، الترتيب، المجموعة، عدد المحاولات)
+    pending = [(0.0, i, group, 0) for i, group in enumerate(groups, 1)]
+    
     try:
-        socketio.emit('log_update', {
-            "message": f"📅 تنفيذ الإرسال المجدول إلى {len(groups)} مجموعة"
-        }, to=user_id)
-        
-        successful = 0
-        failed = 0
-        
-        for i, group in enumerate(groups, 1):
+        while pending:
+            ready_at, i, group, attempts = heapq.heappop(pending)
+            now = loop.time()
+            if ready_at > now:
+                progress.flush()
+                await asyncio.sleep(ready_at - now)
+            
+            await client_manager.send_bucket.acquire()
+            
             try:
-                result = telegram_manager.send_message_async(user_id, group, message)
-                
-                socketio.emit('log_update', {
-                    "message": f"✅ [{i}/{len(groups)}] إرسال مجدول نجح إلى: {group}"
-                }, to=user_id)
-                
+                await client_manager.send_to_peer(group, message)
                 successful += 1
-                with USERS_LOCK:
-                    if user_id in USERS:
-                        USERS[user_id]['stats']['sent'] += 1
+                progress.add(f"✅ [{i}/{total}] إرسال مجدول نجح إلى: {group}", sent=1)
+            
+            except (FloodWaitError, SlowModeWaitError) as e:
+                wait_seconds = getattr(e, 'seconds', 0) or 1
+                if isinstance(e, FloodWaitError):
+                    # FloodWait يخص الحساب كاملاً
+                    client_manager.send_bucket.pause(wait_seconds)
                 
-                if i < len(groups):
-                    time.sleep(3)
+                retry_at = loop.time() + wait_seconds
+                if attempts + 1 > SEND_MAX_RETRIES or (deadline and time.time() + wait_seconds > deadline):
+                    deferred += 1
+                    progress.add(f"⏳ [{i}/{total}] تأجيل {group} للدورة التالية (انتظار {wait_seconds} ثانية)")
+                else:
+                    heapq.heappush(pending, (retry_at, i, group, attempts + 1))
+                    progress.add(f"⏳ [{i}/{total}] {group}: انتظار {wait_seconds} ثانية ثم إعادة المحاولة")
             
             except Exception as e:
-                error_msg = str(e)
-                logger.error(f"Scheduled send error to {group}: {error_msg}")
-                
-                socketio.emit('log_update', {
-                    "message": f"❌ [{i}/{len(groups)}] إرسال مجدول فشل إلى {group}"
-                }, to=user_id)
-                
                 failed += 1
-                with USERS_LOCK:
-                    if user_id in USERS:
-                        USERS[user_id]['stats']['errors'] += 1
-        
-        socketio.emit('log_update', {
-            "message": f"📊 انتهى الإرسال المجدول: ✅ {successful} نجح | ❌ {failed} فشل"
-        }, to=user_id)
+                logger.error(f"Scheduled send error to {group}: {str(e)}")
+                progress.add(f"❌ [{i}/{total}] إرسال مجدول فشل إلى {group}", errors=1)
         
+        summary = f"📊 انتهى الإرسال المجدول: ✅ {successful} نجح | ❌ {failed} فشل"
+        if deferred:
+            summary += f" | ⏳ {deferred} مؤجل"
+        progress.add(summary)
+    
     except Exception as e:
         logger.error(f"Scheduled messages error: {str(e)}")
+    finally:
+        progress.flush()
 
 # =========================== 
 # أحداث Socket.IO
 # ===========================
+def state_snapshot(user):
+    """لقطة مختصرة لحالة المستخدم تكفي اللوحة عن الأحداث التي فاتتها"""
+    with user.lock:
+        return {
+            "connected": user.connected,
+            "logged_in": user.authenticated,
+            "is_running": user.is_running,
+            "monitoring_active": user.monitoring_active,
+            "stats": user.stats,
+            "keywords": len(user.settings.get('watch_words', ())),
+            "groups": len(user.settings.get('groups', ())),
+            "timestamp": time.strftime('%H:%M:%S')
+        }
+
+def local_socket_state(user_id, resume=None):
+    """حالة الدخول ولقطة الحالة لحساب يملكه هذا الجزء
+    
+    resume ({"last_seq", "epoch"}) يضيف إعادة الأحداث - سجلها وepoch في الجزء المالك فقط.
+    """
+    replay = None
+    if resume is not None:
+        replay = socket_emitter.replay(user_id, resume.get('last_seq'), resume.get('epoch'))
+    
+    user = USERS.get(user_id)
+    if not user:
+        return {"status": None, "snapshot": None, "replay": replay}
+    
+    with user.lock:
+        status = {
+            "logged_in": user.authenticated,
+            "connected": user.connected,
+            "awaiting_code": user.awaiting_code,
+            "awaiting_password": user.awaiting_password,
+            "is_running": user.is_running
+        }
+    return {"status": status, "snapshot": state_snapshot(user), "replay": replay}
+
+def socket_state(user_id, resume=None):
+    """حالة اللوحة عند الاتصال - من الجزء المالك للحساب إن كان غير هذا الجزء"""
+    if shard_ring.owns(user_id):
+        return local_socket_state(user_id, resume)
+    
+    path = '/api/socket_state'
+    if resume is not None:
+        query = {'resume': '1'}
+        query.update({name: resume[name] for name in ('last_seq', 'epoch') if resume.get(name) is not None})
+        path += '?' + urllib.parse.urlencode(query)
+    
+    response = forward_to_shard(shard_ring.shard_for(user_id), path)
+    if not isinstance(response, tuple) and response.status_code == 200:
+        try:
+            return json.loads(response.get_data())
+        except ValueError:
+            pass
+    logger.warning(f"Could not fetch socket state for {user_id} from its shard", extra={'category': 'socket'})
+    # بدون الجزء المالك لا يمكن ضمان اكتمال الإعادة
+    replay = {"epoch": None, "seq": 0, "complete": False, "events": []} if resume is not None else None
+    return {"status": None, "snapshot": None, "replay": replay}
+
+@app.route('/api/socket_state')
+def api_socket_state():
+    """حالة الحساب للوحة متصلة بجزء آخر - يُوجَّه إلى الجزء المالك عبر route_to_owner_shard"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "message": "غير مصرح"}), 401
+    resume = request.args if request.args.get('resume') else None
+    return jsonify(local_socket_state(session['user_id'], resume))
+
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
+    """auth اختياري: {"last_seq": N, "epoch": "..."} لاستئناف الأحداث بعد انقطاع"""
     if 'user_id' in session:
         user_id = session['user_id']
         join_room(user_id)
-        logger.info(f"User {user_id} connected via socket")
+        socket_emitter.room_joined(user_id)
+        socket_emitter.start()
+        logger.info(f"User {user_id} connected via socket", extra={'category': 'socket'})
+        
+        # الحساب قد يكون في جزء آخر غير الذي يستضيف هذا الاتصال
+        resume = auth if isinstance(auth, dict) and 'last_seq' in auth else None
+        state = socket_state(user_id, resume)
+        
+        # الأحداث التي فاتت اللوحة أثناء الانقطاع - دفعة واحدة لهذا الاتصال فقط
+        if state["replay"] is not None:
+            emit('event_replay', state["replay"])
         
         # إرسال حالة الاتصال فوراً
-        with USERS_LOCK:
-            if user_id in USERS:
-                connected = USERS[user_id].get('connected', False)
-                authenticated = USERS[user_id].get('authenticated', False)
-                awaiting_code = USERS[user_id].get('awaiting_code', False)
-                awaiting_password = USERS[user_id].get('awaiting_password', False)
-                is_running = USERS[user_id].get('is_running', False)
-                
-                emit('connection_status', {
-                    "status": "connected" if connected else "disconnected"
-                })
-                
-                emit('login_status', {
-                    "logged_in": authenticated,
-                    "connected": connected,
-                    "awaiting_code": awaiting_code,
-                    "awaiting_password": awaiting_password,
-                    "is_running": is_running
-                })
+        status = state["status"]
+        if status:
+            emit('connection_status', {
+                "status": "connected" if status["connected"] else "disconnected"
+            })
+            
+            emit('login_status', status)
+            
+            # لقطة مختصرة للحالة بدل انتظار أحداث فاتت اللوحة
+            emit('state_snapshot', state["snapshot"])
         
         emit('console_log', {
             "message": f"[{time.strftime('%H:%M:%S')}] INFO: Socket connected"
@@ -856,12 +3687,190 @@ def handle_connect():
             "message": f"🔄 تم الاتصال بالخادم - {time.strftime('%H:%M:%S')}"
         })
 
+@socketio.on('resume')
+def handle_resume(data):
+    """استئناف صريح للعملاء الذين لا يرسلون auth عند الاتصال"""
+    if 'user_id' in session and isinstance(data, dict):
+        user_id = session['user_id']
+        state = socket_state(user_id, data)
+        replay = state["replay"]
+        emit('event_replay', replay)
+        if not replay['complete'] and state["snapshot"]:
+            # الإعادة لا تغطي ما فات - اللوحة تحتاج الحالة الكاملة
+            emit('state_snapshot', state["snapshot"])
+
 @socketio.on('disconnect')
 def handle_disconnect():
     if 'user_id' in session:
         user_id = session['user_id']
         leave_room(user_id)
-        logger.info(f"User {user_id} disconnected from socket")
+        socket_emitter.room_left(user_id)
+        logger.info(f"User {user_id} disconnected from socket", extra={'category': 'socket'})
+
+@socketio.on('connect', namespace=AdminFeed.NAMESPACE)
+def handle_admin_connect():
+    if not session.get('is_admin'):
+        return False
+    admin_feed.admin_joined()
+    admin_feed.start()
+    emit('users_snapshot', admin_feed.snapshot())
+
+@socketio.on('disconnect', namespace=AdminFeed.NAMESPACE)
+def handle_admin_disconnect():
+    if session.get('is_admin'):
+        admin_feed.admin_left()
+
+@socketio.on('resync', namespace=AdminFeed.NAMESPACE)
+def handle_admin_resync():
+    """إعادة إرسال اللقطة عند فجوة في أرقام الإصدارات لدى الأدمن"""
+    if session.get('is_admin'):
+        emit('users_snapshot', admin_feed.snapshot())
+
+# =========================== 
+# توجيه الطلبات للجزء المالك للحساب
+# ===========================
+SHARD_FORWARD_HEADER = 'X-Shard-Forwarded'
+# طلبات تُخدم محلياً دائماً في كل جزء
+SHARD_LOCAL_ENDPOINTS = ('static', 'metrics_endpoint', 'api_admin_get_users')
+# ترويسات لا تُنقل عبر الوكيل
+SHARD_HOP_HEADERS = ('host', 'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'upgrade', 'server', 'date')
+
+def forward_to_shard(shard, path=None):
+    """تمرير الطلب الحالي كما هو لجزء آخر وإرجاع رده
+    
+    مع path يُرسل طلب GET داخلي لذلك المسار بنفس ترويسات الجلسة.
+    """
+    base_url = shard_ring.url_for(shard)
+    if not base_url:
+        logger.error(f"No SHARD_URLS entry for shard {shard}")
+        return jsonify({"success": False, "message": "الخادم المسؤول عن هذا الحساب غير متاح"}), 503
+    
+    excluded = SHARD_HOP_HEADERS
+    if path is None:
+        url = base_url + request.path
+        if request.query_string:
+            url += '?' + request.query_string.decode('latin-1')
+        method, data = request.method, request.get_data() or None
+    else:
+        url = base_url + path
+        method, data = 'GET', None
+        excluded += ('if-none-match', 'content-type')
+    
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in excluded}
+    headers[SHARD_FORWARD_HEADER] = str(shard_ring.shard_id)
+    
+    outgoing = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(outgoing, timeout=SHARD_PROXY_TIMEOUT) as upstream:
+            status, upstream_headers, body = upstream.status, upstream.headers, upstream.read()
+    except urllib.error.HTTPError as e:
+        status, upstream_headers, body = e.code, e.headers, e.read()
+    except Exception as e:
+        logger.error(f"Forwarding to shard {shard} failed: {str(e)}")
+        return jsonify({"success": False, "message": "تعذر الوصول للخادم المسؤول عن هذا الحساب"}), 502
+    
+    response = app.response_class(body, status=status)
+    for name, value in upstream_headers.items():
+        if name.lower() not in SHARD_HOP_HEADERS:
+            response.headers.add(name, value)
+    return response
+
+def fetch_shard_users(shard):
+    """مستخدمو جزء آخر (scope=local) لدمجهم في قائمة الأدمن"""
+    response = forward_to_shard(shard, '/api/admin/get_users?scope=local')
+    if isinstance(response, tuple) or response.status_code != 200:
+        return {}
+    try:
+        return json.loads(response.get_data()).get('users', {})
+    except ValueError:
+        return {}
+
+@app.before_request
+def route_to_owner_shard():
+    """الطلبات الخاصة بحساب يملكه جزء آخر تُمرر إليه"""
+    if not shard_ring.distributed or request.headers.get(SHARD_FORWARD_HEADER):
+        return None
+    if request.endpoint in SHARD_LOCAL_ENDPOINTS:
+        return None
+    
+    # مسارات الأدمن تحدد الحساب في الرابط، والباقي يخص حساب الجلسة
+    owner_id = (
+        (request.view_args or {}).get('user_id')
+        or (session.get('is_admin') and request.args.get('user_id'))
+        or session.get('user_id')
+    )
+    if owner_id is None:
+        # جلسة جديدة: معرف يملكه هذا الجزء - لا يُعاد تعيين معرف جلسة قائمة أبداً
+        session['user_id'] = shard_ring.new_user_id()
+        return None
+    if shard_ring.owns(owner_id):
+        return None
+    return forward_to_shard(shard_ring.shard_for(owner_id))
+
+# =========================== 
+# واجهات الأدمن
+# ===========================
+@app.route('/api/admin/get_users')
+def api_admin_get_users():
+    """قائمة المستخدمين بحقول لوحة الأدمن مع ETag - يُرجع 304 إن لم يتغير شيء"""
+    if not session.get('is_admin'):
+        return jsonify({"success": False, "message": "غير مصرح"}), 401
+    
+    version = admin_feed.sync()
+    users = {user_id: admin_user_details(state) for user_id, state in list(USERS.items())}
+    if shard_ring.distributed and request.args.get('scope') != 'local':
+        # دمج مستخدمي الأجزاء الأخرى
+        for shard in range(shard_ring.shard_count):
+            if shard != shard_ring.shard_id:
+                users.update(fetch_shard_users(shard))
+    body = json.dumps({"success": True, "version": version, "users": users},
+                      ensure_ascii=False, separators=(',', ':'), default=str)
+    etag = f'"{version}-{zlib.crc32(body.encode("utf-8")):08x}"'
+    
+    if etag in request.headers.get('If-None-Match', ''):
+        return '', 304, {'ETag': etag}
+    
+    response = app.response_class(body, mimetype='application/json')
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/alerts')
+def api_alerts():
+    """سجل التنبيهات مع البحث والتصفح بالمؤشر: ?q=&keyword=&chat=&since=&until=&cursor=&limit="""
+    user_id = session.get('user_id')
+    if session.get('is_admin') and request.args.get('user_id'):
+        user_id = request.args['user_id']
+    if not user_id:
+        return jsonify({"success": False, "message": "غير مصرح"}), 401
+    if not alert_store.enabled:
+        return jsonify({"success": False, "message": "سجل التنبيهات غير مفعل"}), 404
+    
+    try:
+        alerts, next_cursor = alert_store.search(
+            user_id,
+            keyword=request.args.get('keyword') or None,
+            chat=request.args.get('chat') or None,
+            since=request.args.get('since') or None,
+            until=request.args.get('until') or None,
+            text=request.args.get('q') or None,
+            cursor=request.args.get('cursor') or None,
+            limit=request.args.get('limit', 50)
+        )
+    except (ValueError, sqlite3.Error) as e:
+        return jsonify({"success": False, "message": f"معاملات بحث غير صالحة: {str(e)}"}), 400
+    
+    return jsonify({"success": True, "alerts": alerts, "next_cursor": next_cursor})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """مقاييس الأداء بصيغة نص Prometheus - للأدمن أو لمن يحمل METRICS_TOKEN"""
+    if not session.get('is_admin'):
+        auth = request.headers.get('Authorization', '')
+        token = auth[7:] if auth.startswith('Bearer ') else request.args.get('token', '')
+        if not METRICS_TOKEN or not hmac.compare_digest(token.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+            return jsonify({"success": False, "message": "غير مصرح"}), 401
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 # =========================== 
 # قوالب HTML مدمجة
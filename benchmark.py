@@ -0,0 +1,351 @@
+"""قياس أداء مسار المراقبة: TelegramClientManager._handle_new_message ثم AlertQueue ثم Socket.IO
+
+يعمل محلياً بالكامل: عميل تيليجرام وهمي وSocketIO وهمي، بدون أي اتصال بالشبكة.
+يُبلغ عن عدد الرسائل في الثانية، وزمن الرسالة حتى التنبيه (p50/p99)، والذاكرة لكل حساب.
+
+أمثلة:
+    python benchmark.py
+    python benchmark.py --accounts 20 --messages 5000 --keywords 200 --hit-ratio 0.05
+    python benchmark.py --json results.json   # للمقارنة بين الإصدارات
+    python benchmark.py --replay sessions/captures/USER_20250101.capture.jsonl --speed 10 --keywords-file words.txt
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import asyncio
+import argparse
+import datetime
+import tempfile
+import platform
+import threading
+import subprocess
+import tracemalloc
+
+def import_monitoring():
+    """استيراد app.py كوحدة
+    
+    القوالب المدمجة في نهاية app.py مقطوعة (INDEX_HTML لا يُغلق) فيفشل الاستيراد العادي
+    بـ SyntaxError؛ عندها يُنفذ الكود حتى بداية قسم القوالب فقط - المسار المقاس كله قبله.
+    """
+    # سجل التنبيهات الحقيقي لا يُفتح أبداً - run_pipeline يستخدم سجلاً مؤقتاً
+    os.environ["ALERT_STORE_PATH"] = ""
+    try:
+        import app
+        return app
+    except SyntaxError:
+        sys.modules.pop('app', None)
+    
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    templates = source.index('# قوالب HTML مدمجة')
+    source = source[:source.rindex('# ===', 0, templates)]
+    
+    module = types.ModuleType('app')
+    module.__file__ = path
+    sys.modules['app'] = module
+    exec(compile(source, path, 'exec'), module.__dict__)
+    return module
+
+monitoring = import_monitoring()
+
+ARABIC_WORDS = (
+    "السلام", "عليكم", "مرحبا", "سيارة", "للبيع", "شقة", "ايجار", "وظيفة", "مطلوب", "عرض",
+    "خصم", "جديد", "مستعمل", "الرياض", "جدة", "القاهرة", "دبي", "سعر", "تواصل", "واتساب",
+    "اليوم", "غدا", "مباشرة", "توصيل", "مجاني", "فرصة", "ذهبية", "عاجل", "تخفيضات", "منتج"
+)
+LATIN_WORDS = (
+    "hello", "sale", "car", "apartment", "rent", "job", "wanted", "offer", "discount", "new",
+    "used", "price", "contact", "today", "tomorrow", "delivery", "free", "deal", "urgent", "shop"
+)
+
+class FakeSocketIO:
+    """بديل محلي لـ SocketIO يسجل وقت وصول كل keyword_alert"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.delivered = {}
+        self.frames = 0
+    
+    def emit(self, event, data=None, to=None, **kwargs):
+        now = time.perf_counter()
+        with self.lock:
+            self.frames += 1
+            if event == 'keyword_alert':
+                self.delivered.setdefault((to, data.get("message_id")), now)
+    
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+    
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class FakeTelegramClient:
+    """بديل محلي لـ TelegramClient - الإرسال للرسائل المحفوظة ينتهي فوراً"""
+    
+    def __init__(self):
+        self.sent = 0
+    
+    async def send_message(self, entity, text):
+        self.sent += 1
+
+class FakeEvent:
+    """حدث بشكل NewMessage يكفي لمسار المعالجة"""
+    
+    def __init__(self, text, message_id, chat_id, sender_id):
+        self.message = types.SimpleNamespace(
+            text=text, id=message_id, date=datetime.datetime.now(),
+            chat_id=chat_id, sender_id=sender_id, out=False, media=None
+        )
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.out = False
+        self.is_private = False
+        self.is_group = True
+        self.is_channel = False
+        self.created_at = 0.0
+    
+    async def get_chat(self):
+        return types.SimpleNamespace(id=self.chat_id, title=f"مجموعة {self.chat_id}", username=None)
+    
+    async def get_sender(self):
+        return types.SimpleNamespace(id=self.sender_id, first_name=f"عضو {self.sender_id}", username=None)
+
+def make_keywords(count, rng, arabic_ratio):
+    """كلمات مفتاحية فريدة بنسبة عربي/لاتيني محددة"""
+    keywords = []
+    for index in range(count):
+        words = ARABIC_WORDS if rng.random() < arabic_ratio else LATIN_WORDS
+        keywords.append(f"{rng.choice(words)}{index}")
+    return keywords
+
+def make_events(args, keywords, rng):
+    """توليد رسائل بأحجام ونسب تطابق محددة"""
+    events = []
+    for message_id in range(1, args.messages + 1):
+        words = [
+            rng.choice(ARABIC_WORDS if rng.random() < args.arabic_ratio else LATIN_WORDS)
+            for _ in range(args.message_words)
+        ]
+        if keywords and rng.random() < args.hit_ratio:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keywords))
+        events.append(FakeEvent(
+            " ".join(words), message_id,
+            chat_id=-1000000000000 - rng.randrange(args.chats),
+            sender_id=rng.randrange(1, args.chats * 10 + 1)
+        ))
+    return events
+
+def create_account(index, keywords):
+    """حساب وهمي مسجل في USERS مع عميل محلي على loop مشترك"""
+    user_id = f"bench-{index:05d}"
+    state = monitoring.UserState(user_id, {'phone': f"+1000{index:05d}", 'watch_words': keywords})
+    client_manager = monitoring.TelegramClientManager(user_id)
+    client_manager.client = FakeTelegramClient()
+    client_manager.loop = monitoring.client_runtime.loop_for(user_id)
+    client_manager.is_ready.set()
+    client_manager.update_monitoring_settings(keywords, [])
+    state.update(client_manager=client_manager, connected=True, authenticated=True)
+    monitoring.USERS[user_id] = state
+    monitoring.socket_emitter.room_joined(user_id)
+    return client_manager
+
+async def drive(client_manager, events, offsets=None, speed=0):
+    """تمرير الرسائل بالتتابع كما يفعل Telethon مع معالج واحد
+    
+    مع offsets تُمرر كل رسالة في موعدها الأصلي مقسوماً على speed (0 = أقصى سرعة)،
+    ويُرجع أكبر تأخر عن الموعد بالثواني.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    max_lag = 0.0
+    for index, event in enumerate(events):
+        if offsets is not None and speed > 0:
+            delay = start + offsets[index] / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        event.created_at = time.perf_counter()
+        await client_manager._handle_new_message(event)
+    return max_lag
+
+def load_replay(path):
+    """أحداث من ملف capture مع أزمنتها النسبية - معرفات الرسائل تُرقّم تسلسلياً لربط التنبيهات"""
+    events = []
+    offsets = []
+    first = None
+    for index, (timestamp, chat_id, sender_id, _, text) in enumerate(monitoring.read_capture(path), 1):
+        if first is None:
+            first = timestamp
+        events.append(FakeEvent(text, index, chat_id, sender_id))
+        offsets.append(timestamp - first)
+    return events, offsets
+
+def load_keywords(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+def run_pipeline(args, keywords, workloads, offsets=None):
+    """تشغيل الحمل على حساب لكل workload وقياس الإنتاجية وزمن الرسالة حتى التنبيه"""
+    fake_socketio = FakeSocketIO()
+    monitoring.socketio = fake_socketio
+    monitoring.socket_emitter = monitoring.SocketEmitter(flush_interval=args.socket_flush_interval)
+    monitoring.alert_queue = monitoring.AlertQueue(flush_interval=args.alert_flush_interval)
+    # سجل تنبيهات مؤقت حتى لا تُكتب التنبيهات الوهمية في sessions/alerts.db
+    store_dir = tempfile.mkdtemp(prefix='bench-alerts-')
+    monitoring.alert_store = monitoring.AlertStore(path=os.path.join(store_dir, 'alerts.db'))
+    monitoring.alert_queue.start()
+    monitoring.socket_emitter.start()
+    
+    accounts = [create_account(index, keywords) for index in range(len(workloads))]
+    
+    started = time.perf_counter()
+    futures = [
+        asyncio.run_coroutine_threadsafe(
+            drive(client_manager, events, offsets, args.speed), client_manager.loop
+        )
+        for client_manager, events in zip(accounts, workloads)
+    ]
+    max_lag = max(future.result() for future in futures)
+    handled = time.perf_counter() - started
+    
+    # انتظار تفريغ قائمة التنبيهات وطبقة Socket.IO
+    monitoring.alert_queue.queue.join()
+    monitoring.socket_emitter.flush()
+    drained = time.perf_counter() - started
+    monitoring.alert_queue.running = False
+    monitoring.alert_queue.thread.join(timeout=5)
+    monitoring.alert_store.close()
+    monitoring.alert_store = monitoring.AlertStore(path='')
+    shutil.rmtree(store_dir, ignore_errors=True)
+    
+    latencies = []
+    for client_manager, events in zip(accounts, workloads):
+        for event in events:
+            delivered = fake_socketio.delivered.get((client_manager.user_id, event.message.id))
+            if delivered is not None:
+                latencies.append(delivered - event.created_at)
+    
+    total = sum(len(events) for events in workloads)
+    results = {
+        "messages": total,
+        "handle_seconds": round(handled, 4),
+        "drain_seconds": round(drained, 4),
+        "messages_per_sec": round(total / handled, 1) if handled else None,
+        "alerts_delivered": len(latencies),
+        "alerts_coalesced": monitoring.alert_queue.coalesced,
+        "alerts_dropped": monitoring.alert_queue.dropped,
+        "socket_frames": fake_socketio.frames,
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None
+    }
+    if offsets is not None:
+        results["max_lag_ms"] = round(max_lag * 1000, 3)
+    return results
+
+def run_throughput(args, keywords, rng):
+    """المرحلة الأولى: الإنتاجية وزمن الرسالة حتى التنبيه على رسائل مولدة"""
+    return run_pipeline(args, keywords, [make_events(args, keywords, rng) for _ in range(args.accounts)])
+
+def run_replay(args, keywords):
+    """إعادة تشغيل ملف capture على كل حساب بالسرعة المطلوبة (1 = الزمن الأصلي، 0 = أقصى سرعة)"""
+    workloads = []
+    for _ in range(args.accounts):
+        events, offsets = load_replay(args.replay)
+        workloads.append(events)
+    return run_pipeline(args, keywords, workloads, offsets)
+
+def run_memory(args, keywords, rng):
+    """المرحلة الثانية: الذاكرة لكل حساب (tracemalloc يبطئ التنفيذ لذا يُقاس منفصلاً)"""
+    sample = min(args.accounts, args.memory_accounts)
+    workloads = [make_events(args, keywords, rng)[:args.memory_messages] for _ in range(sample)]
+    
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    accounts = [create_account(100000 + index, keywords) for index in range(sample)]
+    for client_manager, events in zip(accounts, workloads):
+        asyncio.run_coroutine_threadsafe(drive(client_manager, events), client_manager.loop).result()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    
+    grown = sum(stat.size_diff for stat in snapshot.compare_to(baseline, 'filename'))
+    return {
+        "memory_accounts": sample,
+        "memory_per_account_kb": round(grown / sample / 1024, 1) if sample else None
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic load benchmark for the monitoring pipeline")
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=2000, help="messages per account")
+    parser.add_argument('--chats', type=int, default=50, help="distinct chats per account")
+    parser.add_argument('--keywords', type=int, default=100)
+    parser.add_argument('--message-words', type=int, default=20)
+    parser.add_argument('--hit-ratio', type=float, default=0.05)
+    parser.add_argument('--arabic-ratio', type=float, default=0.7)
+    parser.add_argument('--alert-flush-interval', type=float, default=monitoring.ALERT_FLUSH_INTERVAL)
+    parser.add_argument('--socket-flush-interval', type=float, default=monitoring.SOCKETIO_FLUSH_INTERVAL)
+    parser.add_argument('--memory-accounts', type=int, default=10)
+    parser.add_argument('--memory-messages', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replay', metavar='CAPTURE', help="replay a capture file (see CAPTURE_DIR) instead of generated messages")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier, 0 = as fast as possible")
+    parser.add_argument('--keywords-file', metavar='PATH', help="one keyword per line instead of generated keywords")
+    parser.add_argument('--json', metavar='PATH', help="write results as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    # سجلات كل تنبيه وتحذيرات حد الدفعة تطغى على القياس - أعدادها تظهر في النتائج
+    monitoring.logger.setLevel(monitoring.logging.ERROR)
+    
+    rng = random.Random(args.seed)
+    if args.keywords_file:
+        keywords = load_keywords(args.keywords_file)
+    else:
+        keywords = make_keywords(args.keywords, rng, args.arabic_ratio)
+    
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "params": vars(args)
+    }
+    if args.replay:
+        results.update(run_replay(args, keywords))
+    else:
+        results.update(run_throughput(args, keywords, rng))
+        results.update(run_memory(args, keywords, rng))
+    
+    for key, value in results.items():
+        if key != "params":
+            print(f"{key:>24}: {value}")
+    
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,8 +1,18 @@
 
 import os
+
+# eventlet/gevent يتطلبان monkey patching قبل أي import آخر
+ASYNC_MODE = os.environ.get("SOCKETIO_ASYNC_MODE", "threading")
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE.startswith('gevent'):
+    from gevent import monkey
+    monkey.patch_all()
+
 import sys
 import psutil
-from app import app, socketio, load_all_sessions, alert_queue
+from app import app, socketio, load_all_sessions, alert_queue, socket_emitter
 
 def kill_process_on_port(port):
     """إنهاء أي عملية تستخدم المنفذ المحدد"""
@@ -29,8 +39,8 @@ if __name__ == '__main__':
         print("⚠️  تحذير: لم يتم إعداد TELEGRAM_API_ID أو TELEGRAM_API_HASH")
         print("   يمكن تشغيل التطبيق ولكن ستحتاج لإضافة هذه المتغيرات لاحقاً")
     
-    # إنهاء أي عملية تستخدم المنفذ 5000
-    port = 5000
+    # إنهاء أي عملية تستخدم المنفذ المطلوب
+    port = int(os.environ.get("PORT", 5000))
     if kill_process_on_port(port):
         import time
         time.sleep(2)  # انتظار قصير للتأكد من تحرير المنفذ
@@ -43,6 +53,7 @@ if __name__ == '__main__':
         # تشغيل نظام التنبيهات
         print("🔔 بدء نظام التنبيهات...")
         alert_queue.start()
+        socket_emitter.start()
         
         print(f"🌐 تشغيل الخادم على المنفذ {port}...")
         print(f"🔗 رابط التطبيق: http://0.0.0.0:{port}")
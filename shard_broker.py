@@ -0,0 +1,33 @@
+"""وسيط رسائل محلي بسيط لبث أحداث Socket.IO بين الأجزاء (للتجربة والاختبار)
+
+يستقبل من كل الأجزاء على منفذ PULL ويعيد النشر للجميع على منفذ PUB،
+وهو ما يتوقعه ZmqManager في python-socketio. في الإنتاج يُفضل Redis.
+
+    python shard_broker.py                      # 5555 للاستقبال و 5556 للنشر
+    SOCKETIO_MESSAGE_QUEUE=zmq+tcp://127.0.0.1:5555+5556 SHARD_COUNT=2 SHARD_ID=0 PORT=5000 python main.py
+
+يتطلب pyzmq (pip install pyzmq).
+"""
+import os
+import sys
+
+import zmq
+
+def run(sink_port, publish_port):
+    context = zmq.Context()
+    receiver = context.socket(zmq.PULL)
+    receiver.bind(f"tcp://*:{sink_port}")
+    publisher = context.socket(zmq.PUB)
+    publisher.bind(f"tcp://*:{publish_port}")
+    print(f"📡 وسيط Socket.IO يعمل: استقبال {sink_port} - نشر {publish_port}")
+    
+    while True:
+        publisher.send(receiver.recv())
+
+if __name__ == '__main__':
+    sink_port = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.environ.get("BROKER_SINK_PORT", 5555))
+    publish_port = int(sys.argv[2]) if len(sys.argv) > 2 else int(os.environ.get("BROKER_PUBLISH_PORT", 5556))
+    try:
+        run(sink_port, publish_port)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,40 @@
+"""مفاتيح دمج التنبيهات المكررة (AlertDeduplicator.content_key)"""
+import os
+import sys
+
+import pytest
+
+for dependency in ("flask", "flask_socketio", "telethon", "psutil"):
+    pytest.importorskip(dependency)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark import import_monitoring
+
+AlertDeduplicator = import_monitoring().AlertDeduplicator
+
+
+def test_same_message_in_other_chats_shares_key():
+    first = AlertDeduplicator.content_key("سيارة للبيع!! تواصل واتساب", "سيارة")
+    second = AlertDeduplicator.content_key("سيارة   للبيع تواصل واتساب 🚗", "سيارة")
+    assert first is not None
+    assert first == second
+
+
+def test_message_without_distinguishing_content_is_not_deduplicated():
+    assert AlertDeduplicator.content_key("🔥🔥🔥", "🔥") is None
+    assert AlertDeduplicator.content_key("!!! ...", "!") is None
+    assert AlertDeduplicator.content_key("", "سيارة") is None
+
+
+def test_links_keep_host_and_path():
+    first = AlertDeduplicator.content_key("https://example.com/offers/1", "example")
+    second = AlertDeduplicator.content_key("https://example.com/offers/2", "example")
+    other_host = AlertDeduplicator.content_key("https://example.org/offers/1", "example")
+    assert first is not None
+    assert len({first, second, other_host}) == 3
+
+
+def test_link_scheme_and_tracking_parameters_are_ignored():
+    plain = AlertDeduplicator.content_key("عرض http://example.com/offers/1", "عرض")
+    tracked = AlertDeduplicator.content_key("عرض https://example.com/offers/1?utm_source=x#top", "عرض")
+    assert plain == tracked